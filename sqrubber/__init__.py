@@ -1,7 +1,24 @@
 from .sqrubber import Sqrubber
+from .sqrubber import SqrubberError
+from .sqrubber import InvalidInputError
+from .sqrubber import InvalidOutputError
 from .sqrubber import process_line
+from .sqrubber import parse_line
+from .sqrubber import render_line
 from .sqrubber import add_prefix
 from .sqrubber import split_line_with_column_name
 from .sqrubber import split_insert_line
+from .sqrubber import filter_lines
+from .sqrubber import table_selected
+from .sqrubber import process_raw_line
+from .sqrubber import sample_lines
+from .sqrubber import reorder_for_load
+from .sqrubber import batch_transactions
+from .sqrubber import KeywordMatcher
+from .sqrubber import sniff_input
 from .collisions import Collisions
+from .collisions import CollisionsIndex
+from .profiling import DumpProfile
+from .dedupe import RowDeduper
+from .spool import SpoolWatcher
 
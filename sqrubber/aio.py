@@ -0,0 +1,148 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# asyncio API for sqrubber and collisions, for embedding them in services
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# Standard libs
+import codecs
+import asyncio
+
+# 3rd party libs
+
+# application libs
+try:
+    from .sqrubber import Sqrubber, InvalidInputError, process_line, DECODE_ERRORS, MATCHER
+    from .collisions import Collisions
+except ImportError:
+    from sqrubber import Sqrubber, InvalidInputError, process_line, DECODE_ERRORS, MATCHER
+    from collisions import Collisions
+
+
+BATCH_SIZE = 1000
+# lines read while looking for the first DDL statement before the input is rejected
+SNIFF_LINES = 10000
+
+
+async def iter_lines(source, encoding='utf-8', lines=False):
+    """
+    Normalizes an async source of lines or chunks, as str or bytes, into stripped lines,
+    as Sqrubber.read_dump does for files.
+    :param source: async iterable, e.g. an asyncio.StreamReader
+    :param encoding: encoding of bytes chunks, stray bytes are kept as is
+    :param lines: each item of source is a whole line, with or without its newline, rather than a chunk
+    :return: async generator of str lines
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(DECODE_ERRORS)
+    pending = ''
+    async for chunk in source:
+        if isinstance(chunk, (bytes, bytearray)):
+            chunk = decoder.decode(chunk, final=lines)
+        if lines:
+            yield chunk.strip()
+            continue
+        pending += chunk
+        *found, pending = pending.split('\n')
+        for line in found:
+            yield line.strip()
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.strip()
+
+
+def process_batch(sqrub, batch):
+    """
+    Processes a batch of lines in an executor. Lines process_line cannot transform are passed through.
+    :param sqrub: the Sqrubber holding the state of the stream
+    :param batch: list of lines
+    :return: list of transformed lines and the indent state at the end of the batch, which the caller
+    carries over to the next batch, as a process executor works on a copy of sqrub
+    """
+    out = []
+    for line in batch:
+        new = process_line(line, sqrub, sqrub.prefix, sqrub.schema)
+        out.append(line if new is None else new)
+    return out, sqrub.indent
+
+
+async def scrub_lines(source, prefix=None, schema=None, encoding='utf-8', batch_size=BATCH_SIZE, executor=None,
+                      sniff_lines=SNIFF_LINES, lines=False):
+    """
+    Transforms a dump read from an async source, yielding lines as they are processed.
+    Batches are processed in an executor while the next batch is read, so the event loop is never blocked.
+    :param source: async iterable of lines or chunks, as str or bytes, e.g. an asyncio.StreamReader
+    :param prefix: a SQL name compliant string to be prepended to all tablenames
+    :param schema: a SQL schema name to use for all tables
+    :param encoding: encoding of bytes chunks
+    :param batch_size: number of lines handed to the executor at once
+    :param executor: concurrent.futures executor, the loop's default executor if None
+    :param sniff_lines: number of lines to look through for DDL before rejecting the input
+    :param lines: each item of source is a whole line rather than a chunk, see iter_lines
+    :return: async generator of transformed lines
+    :raises InvalidInputError: if the input is empty or has no DDL in its first sniff_lines lines
+    """
+    loop = asyncio.get_running_loop()
+    source = iter_lines(source, encoding, lines).__aiter__()
+    batch = []
+    sqrub = None
+    async for line in source:
+        batch.append(line)
+        if MATCHER.has_keyword(line):
+            sqrub = Sqrubber(batch)
+            break
+        if len(batch) >= sniff_lines:
+            break
+    if sqrub is None:
+        raise InvalidInputError('Input is not DDL, please check input')
+    sqrub.prefix = prefix
+    sqrub.schema = schema
+    sqrub.indent = False
+    if schema:
+        yield sqrub.set_schema()
+    pending = None
+    async for line in source:
+        batch.append(line)
+        if len(batch) < batch_size:
+            continue
+        if pending is not None:
+            done, sqrub.indent = await pending
+            for out in done:
+                yield out
+        pending = loop.run_in_executor(executor, process_batch, sqrub, batch)
+        batch = []
+    if pending is not None:
+        done, sqrub.indent = await pending
+        for out in done:
+            yield out
+    done, sqrub.indent = await loop.run_in_executor(executor, process_batch, sqrub, batch)
+    for out in done:
+        yield out
+
+
+def collide_doc(doc):
+    """
+    Finds and rewrites duplicate table names in a whole document, in an executor.
+    :param doc: list of lines
+    :return: list of rewritten lines
+    :raises InvalidInputError: if the document has no valid DDL
+    """
+    return Collisions(doc).run()
+
+
+async def collide_lines(source, encoding='utf-8', executor=None, lines=False):
+    """
+    Makes duplicate table names unique in a sqrubbed dump read from an async source.
+    Collisions needs the whole document, so it is collected first and then rewritten in an executor.
+    :param source: async iterable of lines or chunks, as str or bytes, e.g. an asyncio.StreamReader
+    :param encoding: encoding of bytes chunks
+    :param executor: concurrent.futures executor, the loop's default executor if None
+    :param lines: each item of source is a whole line rather than a chunk, see iter_lines
+    :return: async generator of rewritten lines
+    :raises InvalidInputError: if the input is empty or has no valid DDL
+    """
+    doc = [line async for line in iter_lines(source, encoding, lines)]
+    if not doc:
+        raise InvalidInputError('Collisions check needs an input')
+    for line in await asyncio.get_running_loop().run_in_executor(executor, collide_doc, doc):
+        yield line
@@ -10,17 +10,47 @@
 import os
 import sys
 import getopt
+import re
+import locale
+import sqlite3
 import datetime
+import hashlib
+import tempfile
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 # 3rd party libs
 
 # application libs
+try:
+    from .profiling import DumpProfile
+except ImportError:
+    from profiling import DumpProfile
+try:
+    from .sqrubber import InvalidInputError, InvalidOutputError, open_input, open_output, sniff_input, SNIFF_BYTES
+    from .sqrubber import SQL_DUMP_LINE, INSERT_HEAD, DECODE_ERRORS
+    from .sqrubber import ALTER_TABLE_PATTERN, INDEX_PATTERN, REFERENCES_PATTERN, get_table_name, split_table_keys
+except ImportError:
+    from sqrubber import InvalidInputError, InvalidOutputError, open_input, open_output, sniff_input, SNIFF_BYTES
+    from sqrubber import SQL_DUMP_LINE, INSERT_HEAD, DECODE_ERRORS
+    from sqrubber import ALTER_TABLE_PATTERN, INDEX_PATTERN, REFERENCES_PATTERN, get_table_name, split_table_keys
+try:
+    from .dedupe import RowDeduper, dedupe_rows, MEMORY_ROWS
+except ImportError:
+    from dedupe import RowDeduper, dedupe_rows, MEMORY_ROWS
 
 
 # These keywords are verbs and direct objects in initial DDL/DML statements.
-DDL_KEYWORDS = ['create table', 'drop table']
+DDL_KEYWORDS = ['create table', 'create unlogged table', 'drop table']
+CREATE_HEADS = ('create table', 'create unlogged table')
+DDL_PATTERN = re.compile('|'.join(re.escape(tok) for tok in DDL_KEYWORDS), re.IGNORECASE)
 MAX_LENGTH = 63
+# Column added to merged tables, filled with the SQL dump name each row came from.
+SOURCE_COLUMN = 'source_dump'
+# Keys and constraints added by ALTER TABLE, e.g. the deferred keys of load order.
+ADD_KEY_PATTERN = re.compile(r'^(alter table(?:\s+if exists)?(?:\s+only)?\s+(\S+)\s+add\s+)'
+                             r'((?:constraint\s+\S+\s+)?(?:primary key|unique|foreign key)\b.*?);?$', re.IGNORECASE)
+KEY_COLUMNS_PATTERN = re.compile(r'\(([^)]*)\)')
 
 VERSION = '0.5.0'
 
@@ -38,16 +68,309 @@ def insert_suffix(old_string, suffix, table_type='drop'):
 
 def is_processable(line: str):
     """Tests whether the line has processable DDL"""
-    if 'drop table' in line.lower() or 'create table' in line.lower():
-        return True
-    return False
+    return DDL_PATTERN.search(line) is not None
 
 
 def find_dupes(line: str, body):
     """Find and collect all the duplicate tablenames in the document"""
-    for word in DDL_KEYWORDS:
-        if word in line.lower():
-            body.names.update([line.lower()])
+    if DDL_PATTERN.search(line):
+        body.names.update([line.lower()])
+
+
+def sql_dump_name(line: str):
+    """Extracts the sql dump name from a sqrubber generated -- SQL Dump of comment line"""
+    try:
+        return line.rsplit(' ', 1)[1].split('.')[0].lower()
+    except IndexError:
+        return None
+
+
+def table_fingerprint(columns):
+    """
+    Fingerprints a table's column definitions, normalized for case, whitespace and trailing commas.
+    :param columns: the lines between CREATE TABLE and );
+    :return: hex digest
+    """
+    normalized = (' '.join(c.lower().split()).rstrip(',') for c in columns)
+    return hashlib.sha1('\n'.join(c for c in normalized if c).encode('utf-8')).hexdigest()
+
+
+def statement_table(line: str):
+    """Extracts the lowered table name from a DROP TABLE, CREATE [UNLOGGED] TABLE or INSERT INTO line"""
+    lowered = line.lower()
+    for head in ['drop table if exists ', 'drop table ', 'create table ', 'create unlogged table ',
+                 INSERT_HEAD.lower() + ' ']:
+        if lowered.startswith(head):
+            return lowered[len(head):].split('(', 1)[0].rstrip('; ').strip()
+    return None
+
+
+def is_insert(line: str):
+    """Tests whether the line heads an INSERT statement"""
+    return line[:len(INSERT_HEAD)].upper() == INSERT_HEAD
+
+
+def rename_tables(line: str, suffix: str, renamed):
+    """
+    Suffixes the tables renamed in a section where a line other than their DROP/CREATE TABLE
+    names them: INSERT INTO, ALTER TABLE, e.g. the deferred keys of load order, CREATE INDEX ... ON,
+    where the index name is suffixed too, and REFERENCES. Never pass in rows of data.
+    :param line: the line
+    :param suffix: the suffix of the section
+    :param renamed: lowered names of the tables suffixed in the section
+    :return: the rewritten line
+    """
+    if not renamed:
+        return line
+    if is_insert(line):
+        return insert_suffix(line, suffix, 'insert') if statement_table(line) in renamed else line
+    ends = []
+    for pattern, group in [(ALTER_TABLE_PATTERN, 1), (INDEX_PATTERN, 3), (REFERENCES_PATTERN, 2)]:
+        for match in pattern.finditer(line):
+            if match.group(group).lower() in renamed:
+                ends.append(match.end(group))
+                if pattern is INDEX_PATTERN:
+                    ends.append(match.end(2))
+    for end in sorted(ends, reverse=True):
+        line = line[:end] + '_' + suffix + line[end:]
+    return line
+
+
+def add_source_value(row: str, value: str):
+    """Appends a quoted value to the row of data on a line, e.g. (1,E'a'), becomes (1,E'a','db_2'),"""
+    end = len(row.rstrip(',;')) - 1
+    return row[:end] + ",'" + value.replace("'", "''") + "'" + row[end:]
+
+
+def merged_key(clause, table, merged, source_column=SOURCE_COLUMN):
+    """
+    Adapts a key or constraint declaration to merged tables. Keys of a merged table, and foreign keys
+    between merged tables, get the source column, as rows merged from several SQL dumps reuse the same ids.
+    Foreign keys from a merged table to one that is not, or the other way round, are dropped, as the rows
+    of the other SQL dumps cannot satisfy them.
+    :param clause: PRIMARY KEY, UNIQUE or FOREIGN KEY declaration, e.g. FOREIGN KEY (cust_id) REFERENCES c(id)
+    :param table: lowered name of the table declaring it
+    :param merged: lowered names of the merged tables
+    :param source_column: name of the column added to merged tables
+    :return: the declaration, or None to drop it
+    """
+    references = REFERENCES_PATTERN.search(clause)
+    target = references.group(2).lower() in merged if references else table in merged
+    if table not in merged and not target:
+        return clause
+    if table not in merged or not target:
+        return None
+    return KEY_COLUMNS_PATTERN.sub(lambda match: f'({match.group(1)}, {source_column})', clause,
+                                   count=2 if references else 1)
+
+
+def merged_table_block(block, merged, source_column=SOURCE_COLUMN):
+    """
+    Adapts the keys and constraints in a CREATE TABLE block to merged tables with merged_key.
+    Blocks with nothing to change are returned as they are, others have their keys as table level declarations.
+    :param block: the lines of the block, from CREATE TABLE to );
+    :param merged: lowered names of the merged tables
+    :param source_column: name of the column added to merged tables
+    :return: list of lines
+    """
+    table = statement_table(block[0])
+    columns, found = split_table_keys(block[1:-1], str.strip)
+    keys = [key for kind in found for key in found[kind]]
+    adapted = [merged_key(key, table, merged, source_column) for key in keys]
+    if adapted == keys:
+        return block
+    body = [column.strip() for line, column in columns] + [key for key in adapted if key is not None]
+    return [block[0]] + [line + ',' for line in body[:-1]] + body[-1:] + [block[-1]]
+
+
+def rewrite_section(lines, suffix, dupes=None):
+    """
+    Makes duplicate table names unique within one -- SQL Dump of section. Duplicate DROP/CREATE TABLE
+    statements are suffixed, as are the inserts, ALTER TABLE, CREATE INDEX and REFERENCES naming
+    those tables in the section, wherever they are, e.g. after all tables in load order.
+    :param lines: the lines of the section
+    :param suffix: the suffix of the section, None leaves the lines unchanged
+    :param dupes: frozenset of lowered DDL lines that are duplicated, defaults to the set shared with pool workers
+    :return: list of rewritten lines
+    """
+    if dupes is None:
+        dupes = _shared_dupes
+    if suffix is None:
+        return list(lines)
+    renamed = {statement_table(line) for line in lines
+               if line.lower() in dupes and 'drop table' not in line.lower()}
+    out = []
+    in_data = False
+    for line in lines:
+        if in_data:
+            in_data = not line.rstrip().endswith(';')
+        elif is_processable(line):
+            if line.lower() in dupes:
+                line = insert_suffix(line, suffix, 'drop' if 'drop table' in line.lower() else 'create')
+        else:
+            in_data = is_insert(line) and not line.rstrip().endswith(';')
+            line = rename_tables(line, suffix, renamed)
+        out.append(line)
+    return out
+
+
+# frozen set of duplicate lines, shared once with each pool worker by _init_worker
+_shared_dupes = frozenset()
+
+
+def _init_worker(dupes):
+    """Initializer of rewrite pool workers"""
+    global _shared_dupes
+    _shared_dupes = dupes
+
+
+class CollisionsIndex(object):
+    """
+    CollisionsIndex is a disk-backed index of the DDL statements in a sqrubbed SQL dump.
+    It holds table names, statement byte offsets and section membership in a sqlite3 file,
+    so collisions can be found and rewritten in bounded memory for inputs of any size.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sections (name TEXT PRIMARY KEY, suffix TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS statements (offset INTEGER PRIMARY KEY, section TEXT, key TEXT);
+        CREATE INDEX IF NOT EXISTS statements_key ON statements (key);
+    """
+
+    def __init__(self, path=None, encoding=None):
+        """Constructor for CollisionsIndex
+        :param path: path of the sqlite3 index file, a temporary file is used if not given.
+        :param encoding: encoding of the dump, the platform default if not given.
+        """
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='collisions_', suffix='.sqlite3')
+            os.close(handle)
+            self.temporary = True
+        else:
+            self.temporary = False
+        self.path = path
+        self.encoding = encoding
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+
+    def __repr__(self):
+        """ REPR for CollisionsIndex"""
+        return f'< CollisionsIndex {self.path} >'
+
+    def close(self):
+        """Closes the index, removing it if it was a temporary file"""
+        self.db.close()
+        if self.temporary:
+            os.remove(self.path)
+
+    def iter_dump(self, path):
+        """
+        Streams a dump file with the byte offset of each line.
+        Lines are decoded and stripped in the same way as Collisions.read_dump.
+        :param path: the path to read from
+        :return: generator of (offset, line) tuples
+        """
+        if self.encoding:
+            encoding, errors = self.encoding, DECODE_ERRORS
+        else:
+            encoding, errors = locale.getpreferredencoding(False), 'strict'
+        offset = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                yield offset, raw.decode(encoding, errors).strip()
+                offset += len(raw)
+
+    def build(self, path, profile=None):
+        """
+        First pass over the dump, recording every DROP/CREATE TABLE statement and
+        the SQL dump section it belongs to. Anything indexed before, e.g. by an earlier
+        run with the same index file, is cleared first.
+        :param path: the path of the dump to index
+        :param profile: optional DumpProfile to collect figures in the same pass
+        :return: the number of statements indexed
+        """
+        section = None
+        count = 0
+        with self.db:
+            self.db.execute('DELETE FROM statements')
+            self.db.execute('DELETE FROM sections')
+            for offset, line in self.iter_dump(path):
+                if profile:
+                    profile.observe(line)
+                lowered = line.lower()
+                if SQL_DUMP_LINE in lowered:
+                    section = sql_dump_name(line)
+                    self.add_section(section)
+                elif is_processable(line):
+                    self.db.execute('INSERT INTO statements VALUES (?, ?, ?)', (offset, section, lowered))
+                    count += 1
+        return count
+
+    def add_section(self, name: str):
+        """Records a section and makes a unique suffix for it, as Collisions.make_sql_dump_suffixes"""
+        if self.db.execute('SELECT 1 FROM sections WHERE name = ?', (name,)).fetchone():
+            return
+        span = 1
+        while self.db.execute('SELECT 1 FROM sections WHERE suffix = ?',
+                              (Collisions.make_suffix(name, span),)).fetchone():
+            span += 1
+        self.db.execute('INSERT INTO sections VALUES (?, ?)', (name, Collisions.make_suffix(name, span)))
+
+    def statement_count(self):
+        """Number of DDL statements in the index"""
+        return self.db.execute('SELECT COUNT(*) FROM statements').fetchone()[0]
+
+    def suffixes(self):
+        """Suffixes for all sections, as a dict like Collisions.suffixes"""
+        return dict(self.db.execute('SELECT name, suffix FROM sections'))
+
+    def dupes(self):
+        """
+        Iterates the duplicate statements in file order.
+        :return: cursor yielding (offset, suffix) tuples
+        """
+        return self.db.execute("""
+            SELECT s.offset, sec.suffix FROM statements s JOIN sections sec ON s.section = sec.name
+            WHERE s.key IN (SELECT key FROM statements GROUP BY key HAVING COUNT(*) > 1)
+            ORDER BY s.offset""")
+
+    def renamed(self):
+        """
+        Tables whose CREATE TABLE is duplicated, by section.
+        :return: dict of section name to set of lowered table names
+        """
+        renamed = {}
+        for section, key in self.db.execute("""
+                SELECT section, key FROM statements
+                WHERE key IN (SELECT key FROM statements GROUP BY key HAVING COUNT(*) > 1)"""):
+            if 'drop table' not in key:
+                renamed.setdefault(section, set()).add(statement_table(key))
+        return renamed
+
+    def rewrite(self, path):
+        """
+        Second pass over the dump, making duplicate table names unique with the section suffix.
+        Follows the same rules as rewrite_section.
+        :param path: the path of the indexed dump
+        :return: generator of rewritten lines
+        """
+        suffixes, renamed = self.suffixes(), self.renamed()
+        dupes = self.dupes()
+        dupe = dupes.fetchone()
+        section = None
+        in_data = False
+        for offset, line in self.iter_dump(path):
+            if dupe is not None and dupe[0] == offset:
+                line = insert_suffix(line, dupe[1], 'drop' if 'drop table' in line.lower() else 'create')
+                dupe = dupes.fetchone()
+            elif in_data:
+                in_data = not line.rstrip().endswith(';')
+            elif SQL_DUMP_LINE in line.lower():
+                section = sql_dump_name(line)
+            elif not is_processable(line) and section in renamed:
+                in_data = is_insert(line) and not line.rstrip().endswith(';')
+                line = rename_tables(line, suffixes[section], renamed[section])
+            yield line
 
 
 class Collisions(object):
@@ -58,43 +381,97 @@ class Collisions(object):
 
     def __init__(self, infile=None, prefix=None, schema=None):
         """Constructor for Collisions
-        :param infile: input file containing a sqrubbed SQL dump to be processed.
-        """
-        if not infile:
-            print("Warning! Collisions check needs an input file.")
-            try:
-                sys.stdin.close()
-            except SystemError as e:
-                print(e)
-            raise SystemExit()
-        elif isinstance(infile, list):
-            self.infile = None
-            self.doc = infile
-        # FIXME need to be able to test whether type is correct for this.
-        elif os.path.isfile(infile):
-            self.infile = infile
-            self.doc = None
-        else:
-            print("General error ...")
-            try:
-                sys.stdin.close()
-            except ValueError as e:
-                print(e)
-            raise SystemExit()
+        :param infile: a sqrubbed SQL dump to be processed, as a path, a file object or an iterable of lines.
+        """
+        self.infile, self.stream, self.doc = open_input(infile)
         self.print_only = None
         self.outfile = None
         self.version = VERSION
         self.names = Counter()
         self.suffixes = {}
+        self.index = None
+        self.encoding = None
+        self.profile = None
+        self.deduper = None
+        self.source_tables = set()
 
     def __repr__(self):
         """ REPR for Collisions"""
         return f'< Collisions ver {self.version} >'
 
-    @staticmethod
-    def destroy():
-        """Destructor for Collisions"""
-        print("Collisions is finished....")
+    def destroy(self):
+        """Destructor for Collisions, releases the document and the dedupe spill file"""
+        self.doc = None
+        self.stream = None
+        if self.deduper is not None:
+            self.deduper.close()
+
+    def sniff(self, max_bytes=SNIFF_BYTES):
+        """
+        Sniffs a bounded prefix of the input, see sqrubber.sniff_input. Unless an encoding was set,
+        the sniffed encoding is used to read and write the dump, keeping stray bytes past the prefix as is.
+        :param max_bytes: size of the prefix
+        :return: an InputSniff
+        :raises InvalidInputError: if the prefix holds no DDL
+        """
+        sniff, self.stream = sniff_input(self.infile, self.stream, self.doc, max_bytes)
+        if not sniff.has_ddl:
+            raise InvalidInputError('Input has no valid DDL, please check input')
+        if self.encoding is None and sniff.encoding is not None:
+            self.encoding = sniff.encoding
+        return sniff
+
+    def load(self):
+        """
+        Reads the input path or file object into self.doc, unless a list of lines was given.
+        :return: the list of lines
+        """
+        if self.infile is not None:
+            self.doc = self.read_dump(self.infile, self.encoding)
+        elif self.stream is not None:
+            self.doc = [(line.decode(self.encoding or 'utf-8', DECODE_ERRORS) if isinstance(line, bytes)
+                         else line).strip() for line in self.stream]
+            self.stream = None
+        return self.doc
+
+    def run(self, outfile=None, merge_identical=False, source_column=SOURCE_COLUMN, jobs=None):
+        """
+        Loads the input, finds and rewrites collisions in memory, then writes the result.
+        :param outfile: path or text file object to write to, defaults to self.outfile and is ignored if
+        print_only is set. If none is given the rewritten lines are only returned.
+        :param merge_identical: merge duplicate tables with identical definitions, see merge_identical_tables.
+        :param source_column: name of the column added to merged tables.
+        :param jobs: number of worker processes used to rewrite sections, serial if None.
+        :return: the list of rewritten lines
+        :raises InvalidInputError: if the input has no valid DDL
+        """
+        if outfile is not None:
+            self.outfile = outfile
+        sniff = self.sniff()
+        # Without SQL dump sections there is nothing to make tables unique with, which a sniff of the
+        # whole input tells before the read, while a larger input is checked once loaded
+        sections = sniff.sections > 0 or not sniff.complete
+        self.load()
+        if sections:
+            self.make_sql_dump_suffixes()
+            sections = bool(self.suffixes)
+        # Merge duplicate tables with identical definitions, suffixing those that differ
+        if merge_identical and sections:
+            self.source_tables = set(self.merge_identical_tables(source_column))
+        # First find the duplicates
+        for line in self.doc:
+            if sections:
+                find_dupes(line, self)
+            if self.profile:
+                self.profile.observe(line)
+        # Then process those found, in parallel only if the input did not fit in the sniffed prefix
+        if sections:
+            self.process_dupes_parallel(jobs if jobs and not sniff.complete else 1)
+        if self.print_only or self.outfile is not None:
+            self.write_dump()
+        elif self.deduper is not None:
+            self.doc = list(dedupe_rows(self.doc, self.deduper, self.source_tables))
+        return self.doc
 
     def validate(self):
         """
@@ -105,20 +482,16 @@ class Collisions(object):
         if not self.doc:
             return False
         for line in self.doc:
-            if not self._token_in_line(line):
+            if self._token_in_line(line):
                 return True
         return False
 
     def get_sql_dump_name(self, idx: int):
         """ Extracts sql dump file name from sqrubber generated comment block which is the
         dump file name for the current SQL line"""
-        SQL_DUMP_LINE = '-- SQL Dump of '.lower()
         while SQL_DUMP_LINE not in self.doc[idx].lower():
             idx -= 1
-        try:
-            return self.doc[idx].lower().rsplit(' ', 1)[1].split('.')[0].lower()
-        except IndexError:
-            return None
+        return sql_dump_name(self.doc[idx])
 
     def make_sql_dump_suffixes(self):
         """Pass through SQL file and create unique suffixes for all SQL
@@ -133,11 +506,10 @@ class Collisions(object):
 
     def get_all_sql_dump_names(self):
         """Find and report all sql dump file names from sqrubber generated comment blocks"""
-        SQL_DUMP_LINE = '-- SQL Dump of '.lower()
         out = []
         for line in self.doc:
             if SQL_DUMP_LINE in line.lower():
-                out.append(line.rsplit(' ', 1)[1].split('.')[0].lower())
+                out.append(sql_dump_name(line))
         return out
 
     @staticmethod
@@ -162,7 +534,7 @@ class Collisions(object):
     def process_create_table(self, suffix: str, idx: int, recurse=False):
         if not recurse:
             self.doc[idx] = insert_suffix(self.doc[idx], suffix, 'create')
-        while 'insert into' not in self.doc[idx].lower() and idx < len(self.doc) - 1:
+        while INSERT_HEAD.lower() not in self.doc[idx].lower() and idx < len(self.doc) - 1:
             idx += 1
             if is_processable(self.doc[idx]):
                 return
@@ -182,11 +554,13 @@ class Collisions(object):
         table_suffix = self.suffixes[self.get_sql_dump_name(idx)]
         if 'drop table' in line:
             self.process_drop_table(table_suffix, idx)
-        elif 'create table' in line:
+        elif any(head in line for head in CREATE_HEADS):
             self.process_create_table(table_suffix, idx)
 
     def process_dupes(self, line: str, idx: int):
         """Given a list of duplicate table names, make them unique.
+        Only suffixes the DROP/CREATE TABLE statements and the inserts right after them, run rewrites
+        whole sections with rewrite_section, which also follows the tables into other statements.
         self.names is a Counter with frequencies of TNs in document.
         These lines are contextualized by DDL keyword, e.g., DROP tablename is
         different to CREATE tablename and so the test of > 1 is measuring by context.
@@ -197,6 +571,211 @@ class Collisions(object):
             self.process_table_name(line.lower(), idx)
         return
 
+    def merge_identical_tables(self, source_column=SOURCE_COLUMN):
+        """
+        Merges duplicate tables whose column definitions are identical into one table, instead of
+        suffixing each of them. Occurrences of a name are grouped by definition, and in each group the
+        first CREATE TABLE is kept with an added source column, later ones are removed and their inserts
+        fill the source column with the SQL dump name. The largest group keeps the name, the other groups
+        are merged into the name suffixed for the first SQL dump of the group. A definition that appears
+        only once is suffixed as usual. Keys, indexes and SET LOGGED of a merged table are held back until
+        the last SQL dump merged into it has loaded, and its keys get the source column, see merged_key.
+        Run after make_sql_dump_suffixes and before find_dupes.
+        :param source_column: name of the column added to merged tables
+        :return: dict of merged table name to list of SQL dump names merged into it
+        """
+        # First pass: fingerprint every CREATE TABLE by table name and section
+        occurrences = {}
+        section = None
+        for idx, line in enumerate(self.doc):
+            if SQL_DUMP_LINE in line.lower():
+                section = sql_dump_name(line)
+            elif line.lower().startswith(CREATE_HEADS):
+                end = idx + 1
+                while end < len(self.doc) and not self.doc[end].startswith(');'):
+                    end += 1
+                occurrences.setdefault(statement_table(line), []).append(
+                    (section, table_fingerprint(self.doc[idx + 1:end])))
+        # plan of (action, suffix of the target table, None to keep the name) by table name and section
+        plan = {}
+        merged = {}
+        # last section of each group of merged tables, by table name and suffix
+        last = {}
+        for name, found in occurrences.items():
+            if len(found) < 2:
+                continue
+            groups = {}
+            for section, fingerprint in found:
+                groups.setdefault(fingerprint, []).append(section)
+            largest = max(groups.values(), key=len)
+            for sections in groups.values():
+                if len(sections) == 1:
+                    plan[(name, sections[0])] = ('suffix', self.suffixes[sections[0]])
+                    continue
+                suffix = None if sections is largest else self.suffixes[sections[0]]
+                merged[name if suffix is None else f'{name}_{suffix}'] = sections
+                last[(name, suffix)] = sections[-1]
+                for number, section in enumerate(sections):
+                    plan[(name, section)] = ('keep' if number == 0 else 'merge', suffix)
+        suffixed = {}
+        for (name, section), (action, suffix) in plan.items():
+            if suffix is not None:
+                suffixed.setdefault(section, {}).setdefault(suffix, set()).add(name)
+
+        def renamed(line, section):
+            for suffix, names in suffixed.get(section, {}).items():
+                line = rename_tables(line, suffix, names)
+            return line
+
+        def release(section):
+            for group, lines in held.items():
+                if last[group] == section:
+                    out.extend(lines)
+                    lines.clear()
+
+        # Second pass: rewrite the document following the plan
+        out = []
+        # ALTER TABLE and CREATE INDEX lines of the kept tables, by table name and suffix
+        held = {}
+        section = None
+        action = table = None
+        skipping = in_insert = in_data = False
+        for line in self.doc:
+            if skipping:
+                skipping = not line.startswith(');')
+                continue
+            row = in_data
+            if in_data:
+                in_data = not line.rstrip().endswith(';')
+            elif is_insert(line):
+                in_data = not line.rstrip().endswith(';')
+            elif SQL_DUMP_LINE in line.lower():
+                release(section)
+                section = sql_dump_name(line)
+            elif ALTER_TABLE_PATTERN.match(line) or INDEX_PATTERN.match(line):
+                # keys, indexes and SET LOGGED of the kept table replace those of the last merged one
+                name = get_table_name(line).lower()
+                action, suffix = plan.get((name, section), (None, None))
+                if action == 'keep':
+                    held.setdefault((name, suffix), []).append(renamed(line, section))
+                    continue
+                if action == 'merge':
+                    lines = held.get((name, suffix), [])
+                    if last[(name, suffix)] == section and renamed(line, section) in lines:
+                        count = lines.index(renamed(line, section)) + 1
+                        out.extend(lines[:count])
+                        del lines[:count]
+                    continue
+            table = statement_table(line)
+            if table is not None:
+                action, suffix = plan.get((table, section), (None, None))
+                lowered = line.lower()
+                if action == 'merge' and not lowered.startswith(INSERT_HEAD.lower()):
+                    skipping = lowered.startswith(CREATE_HEADS)
+                    continue
+                if suffix is not None:
+                    line = insert_suffix(line, suffix,
+                                         'drop' if lowered.startswith('drop') else
+                                         'create' if lowered.startswith('create') else 'insert')
+                if action in ['keep', 'merge'] and lowered.startswith(INSERT_HEAD.lower()):
+                    line = line.rstrip()[:-1] + f', {source_column})'
+                    in_insert = True
+                elif action == 'keep' and lowered.startswith(CREATE_HEADS):
+                    out.append(line)
+                    action = 'columns'
+                    continue
+            elif action == 'columns' and line.startswith(');'):
+                out[-1] = out[-1].rstrip(',') + ','
+                out.append(f'{source_column} TEXT')
+                action = None
+            elif in_insert and line.strip():
+                line = add_source_value(line.rstrip(), section)
+                in_insert = not line.endswith(';')
+            elif not row:
+                line = renamed(line, section)
+            out.append(line)
+        release(section)
+        self.doc = out
+        self.merge_table_keys(merged, source_column)
+        return merged
+
+    def merge_table_keys(self, merged, source_column=SOURCE_COLUMN):
+        """
+        Adapts the keys and constraints in the document to merged tables, see merged_key.
+        :param merged: names of the merged tables
+        :param source_column: name of the column added to merged tables
+        :return:
+        """
+        merged = {name.lower() for name in merged}
+        out = []
+        block = None
+        in_data = False
+        for line in self.doc:
+            if block is not None:
+                block.append(line)
+                if line.startswith(');'):
+                    out.extend(merged_table_block(block, merged, source_column))
+                    block = None
+                continue
+            if in_data:
+                in_data = not line.rstrip().endswith(';')
+            elif is_insert(line):
+                in_data = not line.rstrip().endswith(';')
+            elif line.lower().startswith(CREATE_HEADS) and line.rstrip().endswith('('):
+                block = [line]
+                continue
+            else:
+                key, index = ADD_KEY_PATTERN.match(line), INDEX_PATTERN.match(line)
+                if key:
+                    clause = merged_key(key.group(3), key.group(2).lower(), merged, source_column)
+                    if clause is None:
+                        continue
+                    line = key.group(1) + clause + ';'
+                elif index and index.group(1).lower() == 'create unique index':
+                    line = line[:index.end()] + merged_key(line[index.end():], index.group(3).lower(), merged,
+                                                           source_column)
+            out.append(line)
+        if block is not None:
+            out.extend(block)
+        self.doc = out
+
+    def get_sections(self):
+        """
+        Splits the document into -- SQL Dump of sections.
+        :return: list of (name, start, end) tuples covering self.doc, a leading block without a
+        section header has the name None
+        """
+        sections = []
+        name, start = None, 0
+        for idx, line in enumerate(self.doc):
+            if SQL_DUMP_LINE in line.lower():
+                if idx > start:
+                    sections.append((name, start, idx))
+                name, start = sql_dump_name(line), idx
+        sections.append((name, start, len(self.doc)))
+        return sections
+
+    def process_dupes_parallel(self, jobs=None):
+        """
+        Rewrites the sections of the document in a pool of processes and stitches them back
+        together in order. Needs self.names and self.suffixes, as process_dupes does.
+        :param jobs: number of worker processes, the number of cpus if None, in process if 1
+        :return:
+        """
+        dupes = frozenset(line for line, count in self.names.items() if count > 1)
+        sections = self.get_sections()
+        chunks = [self.doc[start:end] for name, start, end in sections]
+        suffixes = [self.suffixes.get(name) for name, start, end in sections]
+        if jobs == 1 or len(sections) == 1:
+            results = map(rewrite_section, chunks, suffixes, [dupes] * len(chunks))
+            self.doc = [line for chunk in results for line in chunk]
+            return
+        # hand each worker a few batches of sections rather than one section per round trip
+        chunksize = max(1, len(chunks) // ((jobs or os.cpu_count() or 1) * 4))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(dupes,)) as pool:
+            results = pool.map(rewrite_section, chunks, suffixes, chunksize=chunksize)
+            self.doc = [line for chunk in results for line in chunk]
+
     @staticmethod
     def _token_in_line(line):
         """
@@ -204,42 +783,71 @@ class Collisions(object):
         :param line: line to check
         :return: True if present, False otherwise
         """
-        if any(token in line.lower() for token in DDL_KEYWORDS):
-            return True
-        return False
+        return DDL_PATTERN.search(line) is not None
 
     @staticmethod
-    def read_dump(path):
+    def read_dump(path, encoding=None):
         """
         Takes a path and reads in a dump file for processing
         :param path: the path to read from
+        :param encoding: encoding of the dump, stray bytes are kept as is. The platform default if not given.
         :return: a list of lines in file
         """
         data = []
-        with open(path, 'r') as f:
+        with open(path, 'r', encoding=encoding, errors=DECODE_ERRORS if encoding else None) as f:
             for line in f:
                 data.append(line.strip())
         return data
 
-    def write_dump(self):
+    def write_dump(self, lines=None):
         """
-        Takes the content of Collisions object and writes it to a file
+        Takes the content of Collisions object and writes it to self.outfile, a path or text file object
+        :param lines: iterable of lines to write, defaults to self.doc
         :return:
         """
-        #self.print_only = True
-        if self.print_only:
-            # FIXME this should probably turn into a cmd line flag and even break out from a conf file....
-            print(f"-- Collisions version {self.version}\n")
-            print("-- Collisions output generated on " + str(datetime.datetime.now()) + 3 * "\n")
-            for line in self.doc:
-                print(line)
-            return
-        path = self.outfile
-        with open(path, 'w') as f:
+        if lines is None:
+            lines = self.doc
+        if self.deduper is not None:
+            lines = dedupe_rows(lines, self.deduper, self.source_tables)
+        path = sys.stdout if self.print_only else self.outfile
+        # a streamed rewrite may still be reading the input, so never truncate it in place
+        if self.index is not None and path == self.infile:
+            path = self.outfile + '.tmp'
+        with open_output(path, 'w', encoding=self.encoding, errors=DECODE_ERRORS if self.encoding else None) as f:
             f.write(f"-- Collisions version {self.version}\n")
             f.write("-- Collisions output generated on " + str(datetime.datetime.now()) + 3 * "\n")
-            for line in self.doc:
+            for line in lines:
                 f.write(f"{line}\n")
+        if isinstance(path, str) and path != self.outfile:
+            os.replace(path, self.outfile)
+
+    def run_indexed(self, index_path=None, outfile=None):
+        """
+        Finds and rewrites collisions in bounded memory with a disk-backed CollisionsIndex,
+        streaming the input file twice instead of holding it in self.doc.
+        :param index_path: path of the sqlite3 index file, a temporary file is used if not given.
+        :param outfile: path or text file object to write to, defaults to self.outfile and is ignored if
+        print_only is set.
+        :return: True
+        :raises InvalidInputError: if the input is not a file or has no valid DDL
+        :raises InvalidOutputError: if there is nothing to write to, the rewritten lines are never held
+        """
+        if outfile is not None:
+            self.outfile = outfile
+        if self.infile is None:
+            raise InvalidInputError('Out-of-core mode needs an input file')
+        if not self.print_only and self.outfile is None:
+            raise InvalidOutputError('Out-of-core mode needs an output file')
+        self.sniff()
+        self.index = CollisionsIndex(index_path, self.encoding)
+        try:
+            if not self.index.build(self.infile, self.profile):
+                raise InvalidInputError('Input has no valid DDL, please check input')
+            self.suffixes = self.index.suffixes()
+            self.write_dump(self.index.rewrite(self.infile))
+        finally:
+            self.index.close()
+        return True
 
 
 def usage():
@@ -247,21 +855,48 @@ def usage():
     returns usage string
     """
     output = 'usage: collsions -[hpi] [-h help] [-p print-output-only] ' \
-             '[--overwrite]' \
+             '[--overwrite] [--out-of-core] [--index=<indexfile>] [--encoding=<encoding>] ' \
+             '[--profile=<reportfile>] [-j/--jobs=<workers>] [--merge-identical] ' \
+             '[--source-column=<column>] [--dedupe-rows] [--dedupe-memory-rows=<count>] ' \
+             '[--bloom-bits=<bits>] [--spill-dir=<dir>] ' \
              '[-i/--infile=<inputfile>]'
     return output
 
 
+def report_dedupe(collisions):
+    """Prints the duplicate rows dropped per table"""
+    if collisions.deduper is None:
+        return
+    for table, rows, dropped in collisions.deduper.report():
+        if dropped:
+            print(f"Dropped {dropped} of {rows} rows from {table} as duplicates")
+
+
 def main(argv):
     """
     drives a command line invocation of collision check
     :param argv:
     :return:
     """
+    infile = None
     print_only = False
-    outfile = None
+    overwrite = False
+    out_of_core = False
+    index_path = None
+    encoding = None
+    profile_path = None
+    jobs = None
+    merge_identical = False
+    source_column = SOURCE_COLUMN
+    dedupe = False
+    memory_rows = MEMORY_ROWS
+    bloom_bits = 0
+    spill_dir = None
     try:
-        options, remainder = getopt.gnu_getopt(argv, 'hpi:', ['print', 'infile=', 'overwrite'])
+        options, remainder = getopt.gnu_getopt(argv, 'hpi:j:', ['print', 'infile=', 'overwrite', 'out-of-core',
+                                                                 'index=', 'encoding=', 'profile=', 'jobs=',
+                                                                 'merge-identical', 'source-column=', 'dedupe-rows',
+                                                                 'dedupe-memory-rows=', 'bloom-bits=', 'spill-dir='])
     except getopt.GetoptError:
         print(f"Error. Proper usage is {usage()}")
         sys.exit(2)
@@ -273,37 +908,66 @@ def main(argv):
             print(f"Proper usage is {usage()}")
             sys.exit()
         elif opt in ['-i', '--infile']:
-            collisions = Collisions(arg)
+            infile = arg
         elif opt in ['--overwrite']:
-            outfile = collisions.infile
+            overwrite = True
         elif opt in ['-p', '--print']:
             print_only = True
         elif opt in ['--prefix']:
             prefix = arg
         elif opt in ['--schema']:
             schema = arg
-    if outfile is None:
-        collisions.outfile = collisions.infile + '.cleaned'
-    else:
-        collisions.outfile = outfile
+        elif opt in ['--out-of-core']:
+            out_of_core = True
+        elif opt in ['--index']:
+            out_of_core = True
+            index_path = arg
+        elif opt in ['--encoding']:
+            encoding = arg
+        elif opt in ['--profile']:
+            profile_path = arg
+        elif opt in ['-j', '--jobs']:
+            jobs = int(arg)
+        elif opt in ['--merge-identical']:
+            merge_identical = True
+        elif opt in ['--source-column']:
+            source_column = arg
+        elif opt in ['--dedupe-rows']:
+            dedupe = True
+        elif opt in ['--dedupe-memory-rows']:
+            memory_rows = int(arg)
+        elif opt in ['--bloom-bits']:
+            bloom_bits = int(arg)
+        elif opt in ['--spill-dir']:
+            spill_dir = arg
+    if out_of_core and merge_identical:
+        print("Error. --merge-identical needs the in-memory mode, not --out-of-core")
+        sys.exit(2)
+    try:
+        collisions = Collisions(infile)
+    except InvalidInputError as e:
+        print(f"Error. {e}")
+        sys.exit(2)
+    outfile = infile if overwrite else infile + '.cleaned'
     collisions.print_only = print_only
-    if collisions.infile:
-        collisions.doc = collisions.read_dump(collisions.infile)
-    # Check if there is any valid DDL in the document
-    if not collisions.validate():
+    collisions.encoding = encoding
+    if profile_path:
+        collisions.profile = DumpProfile(encoding or locale.getpreferredencoding(False))
+    if dedupe:
+        collisions.deduper = RowDeduper(memory_rows, bloom_bits, spill_dir)
+    try:
+        if out_of_core:
+            collisions.run_indexed(index_path, outfile)
+        else:
+            collisions.run(outfile, merge_identical, source_column, jobs)
+    except InvalidInputError:
         print("Input has no valid DDL, please check input....")
-        exit()
-    # Find all the sql dump names and print them out.
-    collisions.make_sql_dump_suffixes()
-    # First find the duplicates
-    for line in collisions.doc:
-        find_dupes(line, collisions)
-    # Then process those found
-    for idx, line in enumerate(collisions.doc):
-        collisions.process_dupes(line, idx)
-    collisions.write_dump()
+        sys.exit(1)
+    if collisions.profile:
+        collisions.profile.write(profile_path)
+    report_dedupe(collisions)
     collisions.destroy()
-
+    print("Collisions is finished....")
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,267 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# RowDeduper drops rows of data that were already seen in the same table
+# while Collisions streams a combined SQL dump to its output.
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# Standard libs
+import os
+import sqlite3
+import hashlib
+import tempfile
+from array import array
+from collections import OrderedDict
+
+# 3rd party libs
+
+# application libs
+try:
+    from .sqrubber import INSERT_HEAD, DECODE_ERRORS
+except ImportError:
+    from sqrubber import INSERT_HEAD, DECODE_ERRORS
+
+# Digests held in memory before they are spilled to disk, at 8 to 16 bytes each in a DigestTable
+MEMORY_ROWS = 1000000
+
+
+def row_values(line: str, drop_last=False):
+    """
+    Normalizes a row of data from an INSERT statement to its bare VALUES tuple,
+    e.g. VALUES(1,E'a'), becomes (1,E'a')
+    :param line: the row line
+    :param drop_last: drop the last value of the tuple, e.g. a source column added when merging tables
+    :return: the normalized tuple
+    """
+    row = line.strip()
+    if row[:6].upper() == 'VALUES':
+        row = row[6:].lstrip()
+    row = row.rstrip(',;').rstrip()
+    if drop_last:
+        row = row[:row.rfind(",'")] + ')'
+    return row
+
+
+def row_digest(table: str, row: str):
+    """Hashes a table name and normalized row into a signed 64 bit int"""
+    digest = hashlib.blake2b(f'{table}\0{row}'.encode('utf-8', DECODE_ERRORS), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class BloomFilter(object):
+    """
+    BloomFilter is a bit array answering whether a digest may have been added,
+    so most new rows skip the lookup of spilled digests on disk.
+    """
+
+    def __init__(self, bits, hashes=4):
+        """Constructor for BloomFilter
+        :param bits: size of the bit array
+        :param hashes: number of bits set per digest
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    def __repr__(self):
+        """ REPR for BloomFilter"""
+        return f'< BloomFilter {self.bits} bits, {self.hashes} hashes >'
+
+    def _positions(self, digest: int):
+        h1 = digest & 0xffffffff
+        h2 = (digest >> 32) & 0xffffffff | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, digest: int):
+        for pos in self._positions(digest):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest: int):
+        return all(self.array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+
+class DigestTable(object):
+    """
+    DigestTable is an open addressing hash table of 64 bit digests in an array of fixed width slots,
+    kept at most half full, so a digest takes 8 to 16 bytes where a set of ints takes about 64.
+    """
+
+    def __init__(self, slots=1024):
+        """Constructor for DigestTable
+        :param slots: initial number of slots, a power of two, doubled as the table fills
+        """
+        self.slots = slots
+        self.array = array('q', bytes(8 * slots))
+        self.count = 0
+        # 0 marks an empty slot, so a zero digest is held apart
+        self.zero = False
+
+    def __repr__(self):
+        """ REPR for DigestTable"""
+        return f'< DigestTable {self.count} digests in {self.slots} slots >'
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if self.zero:
+            yield 0
+        yield from (digest for digest in self.array if digest)
+
+    def _find(self, digest: int):
+        slots, mask = self.array, self.slots - 1
+        pos = digest & mask
+        found = slots[pos]
+        while found and found != digest:
+            pos = (pos + 1) & mask
+            found = slots[pos]
+        return pos, found
+
+    def __contains__(self, digest: int):
+        if digest == 0:
+            return self.zero
+        return self._find(digest)[1] == digest
+
+    def add(self, digest: int):
+        if digest == 0:
+            self.count += not self.zero
+            self.zero = True
+            return
+        pos, found = self._find(digest)
+        if found:
+            return
+        self.array[pos] = digest
+        self.count += 1
+        if self.count * 2 > self.slots:
+            old = self.array
+            self.slots *= 2
+            self.array = array('q', bytes(8 * self.slots))
+            for digest in old:
+                if digest:
+                    self.array[self._find(digest)[0]] = digest
+
+    def clear(self):
+        self.__init__()
+
+
+class RowDeduper(object):
+    """
+    RowDeduper remembers a fixed width digest of every row of data per table and
+    answers whether a row is an exact duplicate. Digests live in a DigestTable until
+    memory_rows of them are held, then they are spilled to a sqlite3 file.
+    """
+
+    def __init__(self, memory_rows=MEMORY_ROWS, bloom_bits=0, spill_dir=None):
+        """Constructor for RowDeduper
+        :param memory_rows: number of digests held in memory before spilling to disk
+        :param bloom_bits: size of a Bloom filter checked before spilled digests, none if 0
+        :param spill_dir: directory of the spill file, the system temporary directory if not given
+        """
+        self.memory_rows = memory_rows
+        self.bloom = BloomFilter(bloom_bits) if bloom_bits else None
+        self.spill_dir = spill_dir
+        self.digests = DigestTable()
+        self.db = None
+        self.path = None
+        self.rows = OrderedDict()
+        self.dropped = OrderedDict()
+
+    def __repr__(self):
+        """ REPR for RowDeduper"""
+        return f'< RowDeduper {sum(self.dropped.values())} of {sum(self.rows.values())} rows dropped >'
+
+    def seen(self, table: str, row: str):
+        """
+        Tests whether a row was already seen in the table, remembering it if not.
+        :param table: the table name
+        :param row: the normalized row, see row_values
+        :return: True if the row is a duplicate
+        """
+        self.rows[table] = self.rows.get(table, 0) + 1
+        digest = row_digest(table, row)
+        if digest in self.digests or self._spilled(digest):
+            self.dropped[table] = self.dropped.get(table, 0) + 1
+            return True
+        self.digests.add(digest)
+        if self.bloom is not None:
+            self.bloom.add(digest)
+        if len(self.digests) >= self.memory_rows:
+            self.spill()
+        return False
+
+    def _spilled(self, digest: int):
+        if self.db is None or (self.bloom is not None and digest not in self.bloom):
+            return False
+        return self.db.execute('SELECT 1 FROM digests WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def spill(self):
+        """Moves the digests held in memory to the spill file"""
+        if self.db is None:
+            handle, self.path = tempfile.mkstemp(prefix='dedupe_', suffix='.sqlite3', dir=self.spill_dir)
+            os.close(handle)
+            self.db = sqlite3.connect(self.path)
+            self.db.execute('CREATE TABLE digests (digest INTEGER PRIMARY KEY)')
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO digests VALUES (?)', ((d,) for d in self.digests))
+        self.digests.clear()
+
+    def close(self):
+        """Removes the spill file, if any"""
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.path)
+            self.db = None
+
+    def report(self):
+        """
+        Summarizes the rows seen and dropped per table.
+        :return: list of (table, rows, dropped) tuples
+        """
+        return [(table, rows, self.dropped.get(table, 0)) for table, rows in self.rows.items()]
+
+
+def statement_rows(kept):
+    """Rejoins the kept rows of an INSERT statement with VALUES, separators and a final ;"""
+    for idx, (line, row) in enumerate(kept):
+        indent = line[:len(line) - len(line.lstrip())]
+        yield indent + ('VALUES' if idx == 0 else '') + row + (';' if idx == len(kept) - 1 else ',')
+
+
+def dedupe_rows(lines, deduper, source_tables=()):
+    """
+    Drops rows already seen in the same table while streaming the lines of a dump.
+    Statements without duplicates pass unchanged, and statements left without rows are dropped.
+    :param lines: iterable of lines, as produced by Collisions
+    :param deduper: a RowDeduper
+    :param source_tables: lowered names of tables ending in a source column, which is ignored
+    :return: generator of lines
+    """
+    statement = None
+    for line in lines:
+        if statement is None:
+            stripped = line.strip()
+            if stripped.upper().startswith(INSERT_HEAD) and not stripped.endswith(';'):
+                table = stripped[len(INSERT_HEAD):].split('(', 1)[0].strip().lower()
+                statement, kept, dropped = [line], [], False
+            else:
+                yield line
+            continue
+        statement.append(line)
+        if not line.strip():
+            continue
+        normalized = row_values(line, table in source_tables)
+        if deduper.seen(table, normalized):
+            dropped = True
+        else:
+            kept.append((line, row_values(line)))
+        if not line.rstrip().endswith(';'):
+            continue
+        if not dropped:
+            yield from statement
+        elif kept:
+            yield statement[0]
+            yield from statement_rows(kept)
+        statement = None
+    if statement is not None:
+        yield from statement
@@ -0,0 +1,125 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# DumpProfile collects row counts and byte volumes of an SQL dump
+# while Sqrubber or Collisions pass over it.
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# Standard libs
+import re
+import csv
+import json
+from collections import OrderedDict
+
+# 3rd party libs
+
+# application libs
+try:
+    from .sqrubber import SQL_DUMP_LINE, INSERT_HEAD, DECODE_ERRORS
+except ImportError:
+    from sqrubber import SQL_DUMP_LINE, INSERT_HEAD, DECODE_ERRORS
+
+# a row of data in an INSERT statement, e.g. VALUES(1, 'a'), or (2, 'b');
+ROW_PATTERN = re.compile(r'^\s*(?:VALUES\s?)?\(', re.IGNORECASE)
+CSV_FIELDS = ['kind', 'name', 'rows', 'bytes', 'widest_row', 'share']
+
+
+class DumpProfile(object):
+    """
+    DumpProfile counts rows, bytes and the widest row of every table and
+    every -- SQL Dump of section in a dump, for load planning.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        """Constructor for DumpProfile
+        :param encoding: encoding used to measure str lines and to decode bytes lines.
+        """
+        self.encoding = encoding
+        self.tables = OrderedDict()
+        self.sections = OrderedDict()
+        self.table = None
+        self.section = None
+        self.in_insert = False
+
+    def __repr__(self):
+        """ REPR for DumpProfile"""
+        return f'< DumpProfile {len(self.tables)} tables, {len(self.sections)} sections >'
+
+    @staticmethod
+    def _new_entry():
+        return OrderedDict([('rows', 0), ('bytes', 0), ('widest_row', 0)])
+
+    def observe(self, line):
+        """
+        Accounts for one line of a dump. Table names are taken from INSERT INTO lines as they are,
+        so observe lines after they have been standardized.
+        :param line: the line, as str or as raw bytes
+        :return:
+        """
+        if line is None:
+            return
+        if isinstance(line, bytes):
+            line = line.strip()
+            size = len(line)
+            line = line.decode(self.encoding, DECODE_ERRORS)
+        else:
+            line = line.strip()
+            size = None
+        if self.in_insert and ROW_PATTERN.match(line):
+            if size is None:
+                size = len(line.encode(self.encoding, DECODE_ERRORS))
+            self.add_row(size)
+        elif line.upper().startswith(INSERT_HEAD):
+            self.table = line[len(INSERT_HEAD):].split('(', 1)[0].strip()
+            self.in_insert = True
+        elif SQL_DUMP_LINE in line.lower():
+            self.section = line.rsplit(' ', 1)[1].split('.')[0].lower()
+            self.sections.setdefault(self.section, self._new_entry())
+        if line.endswith(';'):
+            self.in_insert = False
+
+    def add_row(self, size: int):
+        """Counts a row of size bytes against the current table and section"""
+        entries = [self.tables.setdefault(self.table, self._new_entry())]
+        if self.section is not None:
+            entries.append(self.sections[self.section])
+        for entry in entries:
+            entry['rows'] += 1
+            entry['bytes'] += size
+            entry['widest_row'] = max(entry['widest_row'], size)
+
+    def as_dict(self):
+        """
+        Summarizes the profile, adding each section's share of the total bytes.
+        :return: an OrderedDict ready for serialization
+        """
+        total_rows = sum(t['rows'] for t in self.tables.values())
+        total_bytes = sum(t['bytes'] for t in self.tables.values())
+        sections = OrderedDict()
+        for name, entry in self.sections.items():
+            sections[name] = OrderedDict(entry)
+            sections[name]['share'] = round(entry['bytes'] / total_bytes, 6) if total_bytes else 0.0
+        return OrderedDict([('total_rows', total_rows),
+                            ('total_bytes', total_bytes),
+                            ('tables', self.tables),
+                            ('sections', sections)])
+
+    def write(self, path):
+        """
+        Writes the profile to a file, as CSV if path ends in .csv and as JSON otherwise.
+        :param path: the path to write to
+        :return:
+        """
+        report = self.as_dict()
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+                for kind in ['tables', 'sections']:
+                    for name, entry in report[kind].items():
+                        writer.writerow(dict(entry, kind=kind[:-1], name=name))
+            return
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
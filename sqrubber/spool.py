@@ -0,0 +1,245 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# Spool watches a directory for SQL dumps and runs sqrubber and collisions
+# on each new file in a persistent pool of worker processes.
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# Standard libs
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import signal
+import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# 3rd party libs
+
+# application libs
+try:
+    from . import sqrubber
+    from . import collisions
+except ImportError:
+    import sqrubber
+    import collisions
+
+
+VERSION = '0.1.0'
+# files still being written by the ingest are expected to carry one of these
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.partial')
+
+
+def process_file(path, out_dir, prefix=None, schema=None):
+    """
+    Runs sqrubber and then collisions on one dump, inside a pool worker.
+    Workers live as long as the pool, so module level caches, e.g. of standardized names, stay warm.
+    :param path: the dump to process
+    :param out_dir: the directory to write the cleaned dump to
+    :param prefix: prefix string passed on to sqrubber
+    :param schema: schema name passed on to sqrubber
+    :return: tuple of path, error message or None, and seconds taken
+    """
+    start = time.time()
+    outfile = os.path.join(out_dir, os.path.basename(path))
+    error = None
+    try:
+        sqrubber.Sqrubber(path, prefix, schema).run(outfile)
+        collisions.Collisions(outfile).run(outfile)
+    except sqrubber.SqrubberError as e:
+        error = f'rejected, {e}'
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    if error is not None and os.path.exists(outfile):
+        os.remove(outfile)
+    return path, error, time.time() - start
+
+
+def _init_worker():
+    """Initializer of spool pool workers, which would otherwise inherit the watcher's SIGTERM handler"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class SpoolWatcher(object):
+    """
+    SpoolWatcher polls a spool directory and hands each new dump to a persistent pool of workers,
+    moving it to a done or failed directory when finished and keeping a status file up to date.
+    """
+
+    def __init__(self, watch_dir, out_dir=None, done_dir=None, failed_dir=None, status_path=None,
+                 jobs=None, interval=2.0, prefix=None, schema=None):
+        """Constructor for SpoolWatcher
+        :param watch_dir: the spool directory to watch for new dumps.
+        :param out_dir: directory for cleaned dumps, defaults to watch_dir/out.
+        :param done_dir: directory for processed dumps, defaults to watch_dir/done.
+        :param failed_dir: directory for dumps that failed, defaults to watch_dir/failed.
+        :param status_path: path of the JSON status and metrics file, defaults to watch_dir/status.json.
+        :param jobs: number of worker processes, the number of cpus if None.
+        :param interval: seconds between polls of the spool directory.
+        :param prefix: prefix string passed on to sqrubber.
+        :param schema: schema name passed on to sqrubber.
+        """
+        self.watch_dir = watch_dir
+        self.out_dir = out_dir or os.path.join(watch_dir, 'out')
+        self.done_dir = done_dir or os.path.join(watch_dir, 'done')
+        self.failed_dir = failed_dir or os.path.join(watch_dir, 'failed')
+        self.status_path = status_path or os.path.join(watch_dir, 'status.json')
+        for directory in [self.out_dir, self.done_dir, self.failed_dir]:
+            os.makedirs(directory, exist_ok=True)
+        self.jobs = jobs
+        self.interval = interval
+        self.prefix = prefix
+        self.schema = schema
+        self.version = VERSION
+        self.sizes = {}
+        self.in_flight = {}
+        self.stopping = False
+        self.metrics = {'started': str(datetime.datetime.now()), 'processed': 0, 'failed': 0,
+                        'bytes_processed': 0, 'seconds_processing': 0.0, 'last_file': None, 'last_error': None}
+
+    def __repr__(self):
+        """ REPR for SpoolWatcher"""
+        return f'< SpoolWatcher ver {self.version}: watching {self.watch_dir} >'
+
+    def scan(self, settle=True):
+        """
+        Lists dumps in the spool directory that are ready to be processed.
+        :param settle: only report files whose size has not changed since the previous scan
+        :return: sorted list of paths
+        """
+        ready = []
+        sizes = {}
+        for entry in os.scandir(self.watch_dir):
+            if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith(PARTIAL_SUFFIXES):
+                continue
+            if entry.path == self.status_path or entry.path in self.in_flight:
+                continue
+            size = entry.stat().st_size
+            sizes[entry.path] = size
+            if not settle or self.sizes.get(entry.path) == size:
+                ready.append(entry.path)
+        self.sizes = sizes
+        return sorted(ready)
+
+    def finish(self, future):
+        """Moves a finished dump to the done or failed directory and updates the metrics"""
+        path, error, seconds = future.result()
+        size = self.in_flight.pop(path)
+        self.metrics['seconds_processing'] += seconds
+        self.metrics['last_file'] = os.path.basename(path)
+        if error is None:
+            self.metrics['processed'] += 1
+            self.metrics['bytes_processed'] += size
+            shutil.move(path, os.path.join(self.done_dir, os.path.basename(path)))
+        else:
+            self.metrics['failed'] += 1
+            self.metrics['last_error'] = f'{os.path.basename(path)}: {error}'
+            shutil.move(path, os.path.join(self.failed_dir, os.path.basename(path)))
+        self.write_status()
+
+    def write_status(self):
+        """Atomically rewrites the JSON status and metrics file"""
+        status = dict(self.metrics)
+        finished = status['processed'] + status['failed']
+        status['mean_seconds'] = status['seconds_processing'] / finished if finished else 0.0
+        status['in_flight'] = sorted(os.path.basename(path) for path in self.in_flight)
+        status['updated'] = str(datetime.datetime.now())
+        status['state'] = 'stopping' if self.stopping else 'running'
+        tmp = self.status_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(status, f, indent=2)
+            f.write('\n')
+        os.replace(tmp, self.status_path)
+
+    def stop(self, signum=None, frame=None):
+        """Asks the watcher to finish the dumps in flight and exit"""
+        self.stopping = True
+
+    def run(self, once=False):
+        """
+        Polls the spool directory until stopped, processing dumps as they settle.
+        :param once: process the dumps present now, without waiting for them to settle, then return
+        :return:
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        self.write_status()
+        futures = set()
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker) as pool:
+            while not self.stopping:
+                for path in self.scan(settle=not once):
+                    self.in_flight[path] = self.sizes[path]
+                    futures.add(pool.submit(process_file, path, self.out_dir, self.prefix, self.schema))
+                if once:
+                    break
+                if not futures:
+                    time.sleep(self.interval)
+                    continue
+                done, futures = wait(futures, timeout=self.interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.finish(future)
+            self.stopping = True
+            for future in wait(futures)[0]:
+                self.finish(future)
+        self.write_status()
+
+
+def usage():
+    """
+    returns usage string
+    """
+    output = 'usage: spool -[hw] [-h help] [-w/--watch=<spooldir>] [--outdir=<dir>] [--done=<dir>] ' \
+             '[--failed=<dir>] [--status=<statusfile>] [-j/--jobs=<workers>] [--interval=<seconds>] ' \
+             '[--prefix=<prefix>] [--schema=<schema_name>] [--once]'
+    return output
+
+
+def main(argv):
+    """
+    drives a command line invocation of the spool watcher
+    :param argv:
+    :return:
+    """
+    kwargs = {}
+    watch_dir = None
+    once = False
+    try:
+        options, remainder = getopt.gnu_getopt(argv, 'hw:j:', ['watch=', 'outdir=', 'done=', 'failed=', 'status=',
+                                                               'jobs=', 'interval=', 'prefix=', 'schema=', 'once'])
+    except getopt.GetoptError:
+        print(f"Error. Proper usage is {usage()}")
+        sys.exit(2)
+    for opt, arg in options:
+        if opt == '-h':
+            print(f"Proper usage is {usage()}")
+            sys.exit()
+        elif opt in ['-w', '--watch']:
+            watch_dir = arg
+        elif opt in ['--outdir']:
+            kwargs['out_dir'] = arg
+        elif opt in ['--done']:
+            kwargs['done_dir'] = arg
+        elif opt in ['--failed']:
+            kwargs['failed_dir'] = arg
+        elif opt in ['--status']:
+            kwargs['status_path'] = arg
+        elif opt in ['-j', '--jobs']:
+            kwargs['jobs'] = int(arg)
+        elif opt in ['--interval']:
+            kwargs['interval'] = float(arg)
+        elif opt in ['--prefix']:
+            kwargs['prefix'] = arg
+        elif opt in ['--schema']:
+            kwargs['schema'] = arg
+        elif opt in ['--once']:
+            once = True
+    if not watch_dir or not os.path.isdir(watch_dir):
+        print(f"Error. Proper usage is {usage()}")
+        sys.exit(2)
+    SpoolWatcher(watch_dir, **kwargs).run(once)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -10,8 +10,14 @@ import os
 import sys
 import getopt
 import re
+import codecs
+import random
 import datetime
-from collections import OrderedDict
+import itertools
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
 
 # 3rd party libs
 
@@ -35,10 +41,56 @@ SPECIAL_CHARS = OrderedDict([('#', 'num'),
                              ('>', ''),
                              (' ', '_')])  # end with the blanks
 INDENT = ' '*4
+# Statement heads used to cheaply classify lines when filtering tables.
+INSERT_HEAD = 'INSERT INTO'
+# Comment line heading each MDB dump in a combined sqrubber output, matched lower cased.
+SQL_DUMP_LINE = '-- SQL Dump of '.lower()
+TABLE_HEADS = ('INSERT INTO', 'CREATE TABLE', 'DROP TABLE', 'CREATE INDEX', 'CREATE UNIQUE INDEX', 'ALTER TABLE')
+TABLE_NAME_PATTERN = re.compile(r'^\s?(?:insert into|create table|drop table)(?:\s+if exists)?\s+'
+                                r'([A-Za-z0-9 _.#&/~\'\"\-]+?)\s*(?:\(|;|$)', re.IGNORECASE)
+COLUMN_PATTERN = re.compile(r'\s?[\"]?([A-Za-z0-9 _,%$&\-\'#/?>]+)[\"]?(.*,?)')
+# Table level constraints in CREATE TABLE blocks, and index statements, whose identifiers need standardizing.
+CONSTRAINT_PATTERN = re.compile(r'^\s?(?:constraint\s|primary key|foreign key|unique\s?\(|create (?:unique )?index\s)',
+                                re.IGNORECASE)
+INDEX_PATTERN = re.compile(r'^\s?(create (?:unique )?index)\s+("[^"]+"|[^\s"]+)\s+on\s+("[^"]+"|[^\s("]+)',
+                           re.IGNORECASE)
+REFERENCES_PATTERN = re.compile(r'\b(references)\s+("[^"]+"|[^\s("]+)', re.IGNORECASE)
+ALTER_TABLE_PATTERN = re.compile(r'^\s?alter table(?:\s+if exists)?(?:\s+only)?\s+("[^"]+"|[^\s"]+)', re.IGNORECASE)
+QUOTED_PATTERN = re.compile(r'"([^"]+)"')
+# Column level keys and constraints moved out of CREATE TABLE blocks in load order.
+COLUMN_CONSTRAINT_PATTERN = re.compile(r'\s+(PRIMARY KEY|UNIQUE|REFERENCES\s+[^\s(]+\s*\([^)]*\)(?:\s+ON\s+\w+\s+\w+)*)',
+                                       re.IGNORECASE)
+DEFERRED_ALTER_PATTERN = re.compile(r'^ALTER TABLE\s+\S+\s+ADD\s+(?:CONSTRAINT|PRIMARY KEY|FOREIGN KEY|UNIQUE)',
+                                    re.IGNORECASE)
+# Row data lines in a dump, which the bytes pipeline passes through without decoding.
+DATA_LINE_BYTES = re.compile(rb'^\s*(?:VALUES\s?)?\((?:E?\'|NULL|\d+,)', re.IGNORECASE)
+# Error handler that round-trips stray bytes which are invalid in the chosen encoding.
+DECODE_ERRORS = 'surrogateescape'
+# Bounded prefix of the input sniffed for format, encoding and DDL before any full read.
+SNIFF_BYTES = 1 << 20
+# MDB Viewer dumps that are not UTF-8 come from Windows code pages.
+FALLBACK_ENCODING = 'cp1252'
+BOM_ENCODINGS = [(codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+# Placeholder in a parsed line for a table or index name, rendered per prefix and schema.
+TableName = namedtuple('TableName', ['name', 'kind'])
+InputSniff = namedtuple('InputSniff', ['format', 'encoding', 'has_ddl', 'sections', 'complete'])
 
 VERSION = '0.3.2'
 
 
+class SqrubberError(Exception):
+    """Base class for errors raised by sqrubber"""
+
+
+class InvalidInputError(SqrubberError, ValueError):
+    """The input is missing, unreadable or has no valid DDL"""
+
+
+class InvalidOutputError(SqrubberError, ValueError):
+    """No output to write to was given where one is needed"""
+
+
+@lru_cache(maxsize=65536)
 def standardize_name(name, prefix=None, schema=None):
     """
     Replace special characters in column or table names.
@@ -61,6 +113,88 @@ def standardize_name(name, prefix=None, schema=None):
     return name.lower()
 
 
+class KeywordMatcher(object):
+    """
+    KeywordMatcher classifies a line against the DDL keyword tables in a single pass,
+    with one precompiled alternation regex built from the tables.
+    """
+
+    # named groups in order of precedence, each matched against a table of keywords
+    KINDS = ('other', 'keyword', 'type')
+
+    def __init__(self, keywords=None, other_keywords=None, types=None):
+        """Constructor for KeywordMatcher
+        :param keywords: DDL verbs and direct objects, defaults to DDL_KEYWORDS.
+        :param other_keywords: DDL keywords with no name, defaults to DDL_OTHER_KEYWORDS.
+        :param types: column types, defaults to DDL_TYPES.
+        """
+        self.keywords = list(DDL_KEYWORDS if keywords is None else keywords)
+        self.other_keywords = list(DDL_OTHER_KEYWORDS if other_keywords is None else other_keywords)
+        self.types = list(DDL_TYPES if types is None else types)
+        tables = dict(zip(self.KINDS, (self.other_keywords, self.keywords, self.types)))
+        # longest first, so that e.g. 'double precision' wins over a shorter type at the same position
+        alternations = {kind: '|'.join(re.escape(tok) for tok in sorted(tables[kind], key=len, reverse=True))
+                        for kind in self.KINDS if tables[kind]}
+        if 'keyword' in alternations:
+            alternations['keyword'] = '(?:{})(?: if exists)?'.format(alternations['keyword'])
+        self.pattern = re.compile('|'.join('(?P<{}>{})'.format(kind, alternations[kind])
+                                           for kind in self.KINDS if kind in alternations), re.IGNORECASE)
+        self.keyword_pattern = re.compile(alternations.get('keyword', '(?!)'), re.IGNORECASE)
+
+    def __repr__(self):
+        """ REPR for KeywordMatcher"""
+        return '< KeywordMatcher {} keywords, {} other keywords, {} types >'.format(
+            len(self.keywords), len(self.other_keywords), len(self.types))
+
+    def add_types(self, types):
+        """
+        Makes a new matcher which also recognizes the given column types.
+        :param types: list of column types, e.g. ['varchar', 'numeric']
+        :return: a new KeywordMatcher
+        """
+        return KeywordMatcher(self.keywords, self.other_keywords, self.types + [t.lower() for t in types])
+
+    def classify(self, line):
+        """
+        Classifies a line by the highest precedence keyword table with a token in the line.
+        :param line: line to classify
+        :return: tuple of kind, token lowered and its position in the line, or None. A keyword
+        token includes any following if exists.
+        """
+        best = None
+        for match in self.pattern.finditer(line):
+            rank = self.KINDS.index(match.lastgroup)
+            if best is None or rank < best[0]:
+                best = (rank, match)
+                if rank == 0:
+                    break
+        if best is None:
+            return None
+        match = best[1]
+        return match.lastgroup, match.group().lower(), match.start()
+
+    def has_keyword(self, line):
+        """
+        Checks for a DDL keyword anywhere in the line.
+        :param line: line to check
+        :return: True if present, False otherwise
+        """
+        return self.keyword_pattern.search(line) is not None
+
+
+MATCHER = KeywordMatcher()
+
+
+@lru_cache(maxsize=None)
+def token_pattern(tok):
+    """
+    Compiles the pattern splitting a line beginning with a DDL/DML token, once per token.
+    :param tok: string DDL/DML token
+    :return: compiled pattern
+    """
+    return re.compile(r''.join((r'^\s?', tok, r'\s+([A-Za-z0-9 _#&/~\'\"\-]+)(.*)')))
+
+
 def split_line_with_token(line, tok):
     """
     tokenize the line into components for later use.
@@ -68,8 +202,7 @@ def split_line_with_token(line, tok):
     :param tok: string DDL/DML token found in line
     :return: three strings: DDL/DML token, name, remainder of line
     """
-    pattern = re.compile(r''.join(('^\s?', tok, '\s+([A-Za-z0-9 _#&/~\'\"\-]+)(.*)')))
-    match = re.search(pattern, line.lower())
+    match = token_pattern(tok).search(line.lower())
     name = match.group(1).strip()
     remain = match.group(2)
     return name, remain
@@ -82,32 +215,90 @@ def split_line_with_column_name(line):
     rather a column declaration, e.g. "COLUMN NAME" TEXT,
     :return: two strings: name, remainder of line
     """
-    pattern = re.compile(r'\s?[\"]?([A-Za-z0-9 _,%$&\-\'#/?>]+)[\"]?(.*,?)')
-    match = re.search(pattern, line.lower())
+    match = COLUMN_PATTERN.search(line.lower())
     name = match.group(1).strip()
     remain = match.group(2)
     return name, remain
 
 
-def split_insert_line(line, prefix=None, schema=None):
+def render_line(parsed, prefix=None, schema=None):
     """
-    tokenize an INSERT INTO line into components and standardize all table and column names in the line.
+    Renders a line parsed by parse_line for one prefix and schema.
+    :param parsed: a transformed string, None, or a template tuple of strings and TableName placeholders
+    :param prefix: prefix string to prepend to table and index names
+    :param schema: schema name to prepend to table names
+    :return: transformed string, or None
+    """
+    if not isinstance(parsed, tuple):
+        return parsed
+    return ''.join(piece if isinstance(piece, str) else
+                   standardize_name(piece.name, prefix, schema if piece.kind == 'table' else None)
+                   for piece in parsed)
+
+
+def insert_template(line):
+    """
+    tokenize an INSERT INTO line into components and standardize all column names in the line.
     :param line: incoming string with INSERT INTO at beginning
-    :param prefix: string to prefix to name
-    :param schema: schema name to prepend to name
-    :return: fully standardized line
+    :return: template for render_line, with the table name as placeholder
     """
     new_columns = []
     table_name, columns = line.split('(')
-    table_name = standardize_name(table_name.split('INTO ')[1], prefix, schema)
     columns = columns.replace(')', '')
     columns = columns.replace(', ', '_')
     for index, col in enumerate(columns.split(',')):
         new_columns.append(standardize_name(col, prefix=None, schema=None))
-    return ''.join(('INSERT INTO', ' ', table_name)) + \
-           ' (' + \
-           ', '.join(new_columns) + \
-           ')'
+    return ('INSERT INTO ', TableName(table_name.split('INTO ')[1], 'table'), ' (' + ', '.join(new_columns) + ')')
+
+
+def split_insert_line(line, prefix=None, schema=None):
+    """
+    tokenize an INSERT INTO line into components and standardize all table and column names in the line.
+    :param line: incoming string with INSERT INTO at beginning
+    :param prefix: string to prefix to name
+    :param schema: schema name to prepend to name
+    :return: fully standardized line
+    """
+    return render_line(insert_template(line), prefix, schema)
+
+
+def constraint_template(text):
+    """
+    Standardizes the identifiers in a key, constraint or index declaration that do not depend on
+    prefix or schema: quoted names, e.g. columns, are standardized as they are, while tables after
+    REFERENCES or ON and the index name become placeholders.
+    :param text: the declaration, e.g. FOREIGN KEY ("Cust ID") REFERENCES "Customers" ("ID")
+    :return: template for render_line
+    """
+    def quoted(part):
+        return QUOTED_PATTERN.sub(lambda match: standardize_name(match.group(1)), part)
+
+    pieces = []
+    pos = 0
+    match = INDEX_PATTERN.search(text)
+    if match:
+        pieces += [match.group(1).upper() + ' ', TableName(match.group(2).strip('"'), 'index'), ' ON ',
+                   TableName(match.group(3).strip('"'), 'table')]
+        pos = match.end()
+    for match in REFERENCES_PATTERN.finditer(text, pos):
+        pieces += [quoted(text[pos:match.start()]), match.group(1).upper() + ' ',
+                   TableName(match.group(2).strip('"'), 'table')]
+        pos = match.end()
+    pieces.append(quoted(text[pos:]))
+    return tuple(pieces)
+
+
+def standardize_constraint(text, prefix=None, schema=None):
+    """
+    Standardizes the identifiers in a key, constraint or index declaration.
+    Tables after REFERENCES or ON get prefix and schema, the index name gets the prefix
+    and all other quoted names, e.g. columns, are standardized as they are.
+    :param text: the declaration, e.g. FOREIGN KEY ("Cust ID") REFERENCES "Customers" ("ID")
+    :param prefix: prefix string to prepend to table names
+    :param schema: schema name to prepend to table names
+    :return: the declaration with standardized names
+    """
+    return render_line(constraint_template(text), prefix, schema)
 
 
 def process_line(line, sqrub, prefix=None, schema=None):
@@ -124,6 +315,17 @@ def process_line(line, sqrub, prefix=None, schema=None):
     :param schema: schema name to prepend to name
     :return: transformed string
     """
+    return render_line(parse_line(line, sqrub), prefix, schema)
+
+
+def parse_line(line, sqrub):
+    """
+    Parses and classifies a line of DDL/DML for process_line, leaving out the prefix and schema,
+    so the line can be rendered for several of them with render_line.
+    :param line: the string to work on
+    :param sqrub: an instantiated Sqrubber that has state for attr: indent
+    :return: transformed string if the line has no table names, a template tuple if it has, or None
+    """
 
     indent = sqrub.indent
     # test if end of line has end of block
@@ -138,39 +340,571 @@ def process_line(line, sqrub, prefix=None, schema=None):
     # CASE: INSERT INTO
     if re.search(r'^INSERT INTO', line.upper()):
         sqrub.indent = True
-        return split_insert_line(line, prefix, schema)
+        return insert_template(line)
     # CASE: VALUES or sub-line
     if re.search(r'VALUES\s?\((E?\'|NULL|\d+,)', line.upper()):
         return '    ' + line
     if re.search(r'\s?\((E?\'|NULL|\d+,)', line.upper()):
         return '          ' + line
+    # CASE: table level key or constraint, or index
+    if CONSTRAINT_PATTERN.search(line):
+        template = constraint_template(line.strip())
+        return (INDENT + ' ',) + template if indent else template
+    # CASE: ALTER TABLE, whose name ends at the quote or blank rather than at ( or ;
+    match = ALTER_TABLE_PATTERN.search(line)
+    if match:
+        return (line[:match.start(1)].strip().upper() + ' ', TableName(match.group(1).strip('"'), 'table')) + \
+            constraint_template(line[match.end():])
+    found = sqrub.matcher.classify(line)
+    if found is None:
+        return
+    kind, tok = found[:2]
     # special DDL line with no name
-    for tok in DDL_OTHER_KEYWORDS:
-        if re.search(r''.join(tok), line.lower()):
-            return line
-    # set up initial values of name and remain for existence test later
-    name = None
-    remain = None
-    for tok in DDL_KEYWORDS:
-        if tok in line.lower():
-            if ' '.join((tok, 'if exists')) in line.lower():
-                tok = ' '.join((tok, 'if exists'))
-            name, remain = split_line_with_token(line, tok)
-            name = standardize_name(name, prefix, schema)
-            sqrub.indent = True
-            return ''.join((tok.upper(), ' ', name, ' ', remain)).replace(' ;', ';')
+    if kind == 'other':
+        return line
+    if kind == 'keyword':
+        name, remain = split_line_with_token(line, tok)
+        sqrub.indent = True
+        return tok.upper() + ' ', TableName(name, 'table'), (' ' + remain).replace(' ;', ';')
     # no token at start of line - column declaration
-    for tok in DDL_TYPES:
-        if tok in line.lower():
-            name, remain = split_line_with_column_name(line)
-            name = standardize_name(name, prefix=None, schema=None)
-            remain = remain.strip()
+    name, remain = split_line_with_column_name(line)
+    name = standardize_name(name, prefix=None, schema=None)
+    remain = remain.strip()
     if not name or not remain:
         return
-    if indent:
-        return ' '.join((INDENT, name, remain.upper()))
+    head = ' '.join((INDENT, name)) if indent else name
+    # keep the names in a column level REFERENCES clause out of the upper casing
+    references = REFERENCES_PATTERN.search(remain)
+    if references:
+        return (' '.join((head, remain[:references.start()].upper().strip())) + ' ',) + \
+            constraint_template(remain[references.start():])
+    return ' '.join((head, remain.upper()))
+
+
+def get_table_name(line):
+    """
+    Extracts the raw table name from an INSERT INTO, CREATE TABLE, DROP TABLE or ALTER TABLE line,
+    or the name of the indexed table from a CREATE [UNIQUE] INDEX ... ON line.
+    :param line: incoming line beginning with one of the TABLE_HEADS
+    :return: the raw table name without enclosing quotes, or None if there is none
+    """
+    match = INDEX_PATTERN.search(line)
+    if match:
+        return match.group(3).strip('"')
+    match = ALTER_TABLE_PATTERN.search(line) or TABLE_NAME_PATTERN.search(line)
+    if not match:
+        return None
+    return match.group(1).strip().strip('"')
+
+
+def table_selected(name, include=None, exclude=None, prefix=None, schema=None):
+    """
+    Tests a table name against include and exclude patterns.
+    Patterns are shell-style wildcards and match either the raw name or the standardized
+    name, with or without prefix and schema.
+    :param name: the raw table name
+    :param include: list of patterns, at least one of which must match, if given
+    :param exclude: list of patterns, none of which may match
+    :param prefix: prefix string used to standardize the name
+    :param schema: schema name used to standardize the name
+    :return: True if the table is to be kept, False otherwise
+    """
+    if not include and not exclude:
+        return True
+    candidates = {name.lower(), standardize_name(name), standardize_name(name, prefix, schema)}
+
+    def matches(patterns):
+        return any(fnmatchcase(c, p.lower()) for p in patterns for c in candidates)
+
+    if include and not matches(include):
+        return False
+    if exclude and matches(exclude):
+        return False
+    return True
+
+
+def filter_lines(lines, sqrub, encoding=None):
+    """
+    Drops statements for tables that are not selected, and all data statements in schema-only mode.
+    Indexes go with the table they are on, and ALTER TABLE statements also go when they
+    reference a table that is not selected. Data lines of a dropped statement are discarded
+    with a cheap prefix check until the statement ends, so they never reach process_line.
+    :param lines: iterable of stripped dump lines, or of raw byte lines if encoding is given
+    :param sqrub: an instantiated Sqrubber with attrs include_tables, exclude_tables and schema_only
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: generator of the lines to keep
+    """
+    heads, insert_head, alter_head, end = TABLE_HEADS, INSERT_HEAD, 'ALTER TABLE', ';'
+    if encoding:
+        heads = tuple(head.encode(encoding) for head in TABLE_HEADS)
+        insert_head, alter_head, end = (h.encode(encoding) for h in (insert_head, alter_head, end))
+    width = max(len(head) for head in TABLE_HEADS)
+
+    def decoded(line):
+        return line.strip().decode(encoding, DECODE_ERRORS) if encoding else line
+
+    def selected(text, alter=False):
+        names = [get_table_name(text)]
+        if alter:
+            names.extend(match.group(2).strip('"') for match in REFERENCES_PATTERN.finditer(text))
+        return all(name is None or table_selected(name, sqrub.include_tables, sqrub.exclude_tables,
+                                                  sqrub.prefix, sqrub.schema) for name in names)
+
+    skipping = False
+    held = None
+    for line in lines:
+        stripped = line.strip() if encoding else line
+        if skipping:
+            if stripped.endswith(end):
+                skipping = False
+            continue
+        if held is not None:
+            # an ALTER TABLE spanning lines is held until its end, where a REFERENCES may be
+            held.append(line)
+            if stripped.endswith(end):
+                if selected(' '.join(decoded(held_line) for held_line in held), alter=True):
+                    yield from held
+                held = None
+            continue
+        head = stripped[:width].upper()
+        if not head.startswith(heads):
+            yield line
+            continue
+        if head.startswith(alter_head) and not stripped.endswith(end):
+            held = [line]
+            continue
+        if sqrub.schema_only and head.startswith(insert_head):
+            keep = False
+        else:
+            keep = selected(decoded(line), alter=head.startswith(alter_head))
+        if keep:
+            yield line
+        elif not stripped.endswith(end):
+            skipping = True
+    if held is not None:
+        yield from held
+
+
+def end_row(line, end, encoding=None):
+    """
+    Replaces the terminator of a row line, e.g. the , of a row that becomes the last one of its statement.
+    :param line: the row line, stripped str or raw bytes with its line ending
+    :param end: the new terminator, ',' or ';'
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: the line with its terminator replaced
+    """
+    if not encoding:
+        return line[:-1] + end if line.endswith((',', ';')) else line
+    body = line.rstrip()
+    if body.endswith((b',', b';')):
+        body = body[:-1] + end.encode(encoding)
+    return body + line[len(line.rstrip(b'\r\n')):]
+
+
+def start_row(line, encoding=None):
+    """
+    Makes a row line the first of its statement by putting VALUES in front of it, if it is missing.
+    :param line: the row line, stripped str or raw bytes with its line ending
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: the line beginning with VALUES
+    """
+    values = 'VALUES'.encode(encoding) if encoding else 'VALUES'
+    stripped = line.lstrip()
+    if stripped[:6].upper() == values:
+        return line
+    return line[:len(line) - len(stripped)] + values + stripped
+
+
+def sample_lines(lines, sqrub, encoding=None):
+    """
+    Keeps all DDL but only a sample of the rows of each table's INSERT statements, either the
+    first sqrub.sample rows of each table or each row with probability sqrub.sample_fraction.
+    Kept rows are re-terminated so that every statement stays valid. Once a table has its
+    sample, the rest of its data lines are skipped with a cheap check for the end of statement.
+    :param lines: iterable of stripped dump lines, or of raw byte lines if encoding is given
+    :param sqrub: an instantiated Sqrubber with attrs sample, sample_fraction and sample_seed
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: generator of the lines to keep
+    """
+    insert_head = INSERT_HEAD.encode(encoding) if encoding else INSERT_HEAD
+    end = b';' if encoding else ';'
+    rng = random.Random(sqrub.sample_seed)
+    counts = {}
+    table = header = held = None
+    in_statement = skipping = False
+    for line in lines:
+        stripped = line.strip() if encoding else line
+        if skipping:
+            if stripped.endswith(end):
+                skipping = False
+            continue
+        if not in_statement:
+            if stripped[:11].upper() != insert_head or stripped.endswith(end):
+                yield line
+                continue
+            table = get_table_name(stripped.decode(encoding, DECODE_ERRORS) if encoding else stripped)
+            counts.setdefault(table, 0)
+            if sqrub.sample is not None and counts[table] >= sqrub.sample:
+                skipping = True
+                continue
+            header, held, in_statement = line, None, True
+            continue
+        last = stripped.endswith(end)
+        if sqrub.sample is not None:
+            keep = counts[table] < sqrub.sample
+        else:
+            keep = rng.random() < sqrub.sample_fraction
+        if keep:
+            counts[table] += 1
+            if header is not None:
+                yield header
+                header = None
+                line = start_row(line, encoding)
+            if held is not None:
+                yield end_row(held, ',', encoding)
+            held = line
+        full = sqrub.sample is not None and counts[table] >= sqrub.sample
+        if last or full:
+            if held is not None:
+                yield end_row(held, ';', encoding)
+            in_statement = False
+            skipping = full and not last
+
+
+def reorder_for_load(lines, encoding=None):
+    """
+    Reorders processed output for a bulk load: bare table DDL first, then all data, then
+    primary keys, unique constraints, foreign keys and indexes as separate ALTER TABLE and
+    CREATE INDEX statements, so they are built once after the load instead of row by row.
+    :param lines: processed output lines, or raw byte lines if encoding is given
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: list of reordered lines
+    """
+    def text(line):
+        return line.decode(encoding, DECODE_ERRORS).strip() if encoding else line.strip()
+
+    def raw(line, ending=b'\n'):
+        return line.encode(encoding, DECODE_ERRORS) + ending if encoding else line
+
+    def comment(title):
+        return [raw(line) for line in ['', '--', '-- Sqrubber load order: ' + title, '--', '']]
+
+    end = b';' if encoding else ';'
+    tables, data, indexes = [], [], []
+    keys = OrderedDict([('PRIMARY KEY', []), ('UNIQUE', []), ('FOREIGN KEY', [])])
+    target = None
+    block = None
+    for line in lines:
+        if line is None:
+            tables.append(line)
+            continue
+        if target is not None:
+            target.append(line)
+            if line.strip().endswith(end):
+                if target is data:
+                    data.append(raw(''))
+                target = None
+            continue
+        if block is not None:
+            current = text(line)
+            if current.startswith(');'):
+                block.append(line)
+                tables.extend(close_table_block(block, keys, text, raw, encoding))
+                block = None
+            else:
+                block.append(line)
+            continue
+        current = text(line)
+        upper = current[:24].upper()
+        if upper.startswith('INSERT INTO'):
+            target = data
+        elif upper.startswith(('CREATE INDEX', 'CREATE UNIQUE INDEX')):
+            target = indexes
+        elif DEFERRED_ALTER_PATTERN.search(current):
+            target = keys['FOREIGN KEY'] if 'FOREIGN KEY' in current.upper() else keys['PRIMARY KEY']
+        elif upper.startswith('CREATE TABLE') and current.endswith('('):
+            block = [line]
+            continue
+        else:
+            tables.append(line)
+            continue
+        target.append(line)
+        if line.strip().endswith(end):
+            if target is data:
+                data.append(raw(''))
+            target = None
+    if block is not None:
+        tables.extend(block)
+    deferred = [line for kind in keys for line in keys[kind]] + indexes
+    return comment('tables') + tables + comment('data') + data + \
+        comment('keys, constraints and indexes') + deferred
+
+
+def split_table_keys(lines, text):
+    """
+    Separates the keys and constraints from the column definitions in the body of a CREATE TABLE block.
+    Column level keys become table level declarations, e.g. "id INTEGER PRIMARY KEY" gives PRIMARY KEY (id).
+    :param lines: the lines of the block between CREATE TABLE and );
+    :param text: function from a line to its stripped text
+    :return: list of (line, bare column text) tuples, and OrderedDict of kind to list of declarations
+    """
+    columns, found = [], OrderedDict([('PRIMARY KEY', []), ('UNIQUE', []), ('FOREIGN KEY', [])])
+    for line in lines:
+        current = text(line).rstrip(',')
+        if CONSTRAINT_PATTERN.search(current):
+            kind = next((k for k in found if k in current.upper()), 'UNIQUE')
+            found[kind].append(current)
+            continue
+        column = current.split(' ', 1)[0]
+        for match in reversed(list(COLUMN_CONSTRAINT_PATTERN.finditer(current))):
+            clause = match.group(1)
+            if clause.upper() == 'PRIMARY KEY':
+                found['PRIMARY KEY'].append(column)
+            elif clause.upper() == 'UNIQUE':
+                found['UNIQUE'].append(f'UNIQUE ({column})')
+            else:
+                found['FOREIGN KEY'].append(f'FOREIGN KEY ({column}) {clause}')
+            current = current[:match.start()] + current[match.end():]
+        if current.strip():
+            columns.append((line, current))
+    if found['PRIMARY KEY'] and not any(c.upper().startswith(('PRIMARY KEY', 'CONSTRAINT'))
+                                        for c in found['PRIMARY KEY']):
+        found['PRIMARY KEY'] = [f'PRIMARY KEY ({", ".join(found["PRIMARY KEY"])})']
+    return columns, found
+
+
+def close_table_block(block, keys, text, raw, encoding=None):
+    """
+    Strips keys and constraints from a CREATE TABLE block for reorder_for_load, collecting
+    them as ALTER TABLE statements.
+    :param block: the lines of the block, from CREATE TABLE to );
+    :param keys: OrderedDict of kind to list of ALTER TABLE statements, added to in place
+    :param text: function from a line to its stripped text
+    :param raw: function from text to a line
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: the lines of the bare block
+    """
+    table = text(block[0])[len('CREATE TABLE'):-1].strip()
+    if table.upper().startswith('IF EXISTS '):
+        table = table[len('IF EXISTS '):].strip()
+    columns, found = split_table_keys(block[1:-1], text)
+    for kind, constraints in found.items():
+        keys[kind].extend(raw(f'ALTER TABLE {table} ADD {c};') for c in constraints)
+    out = [block[0]]
+    for idx, (line, current) in enumerate(columns):
+        current = current.rstrip() + (',' if idx < len(columns) - 1 else '')
+        if encoding:
+            out.append(raw(' '.join((INDENT, current.strip())), line[len(line.rstrip(b'\r\n')):]))
+        else:
+            out.append(' '.join((INDENT, current.strip())))
+    out.append(block[-1])
+    return out
+
+
+def batch_transactions(lines, statements=None, size=None, encoding=None):
+    """
+    Wraps statements in BEGIN/COMMIT, committing every so many statements or bytes,
+    so a load does not pay for a commit per statement.
+    :param lines: output lines, or raw byte lines if encoding is given
+    :param statements: commit after this many statements
+    :param size: commit once a transaction holds this many bytes, str lines are measured encoded as UTF-8
+    with their line ending
+    :param encoding: encoding of raw byte lines, None for str lines
+    :return: generator of lines with BEGIN; and COMMIT; lines added
+    """
+    begin, commit, end, comment = 'BEGIN;', 'COMMIT;', ';', '--'
+    if encoding:
+        begin, commit = begin.encode(encoding) + b'\n', commit.encode(encoding) + b'\n'
+        end, comment = b';', b'--'
+    in_transaction = False
+    count = nbytes = 0
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(comment):
+            yield line
+            continue
+        if not in_transaction:
+            yield begin
+            in_transaction = True
+        yield line
+        nbytes += len(line) if encoding else len(line.encode('utf-8', DECODE_ERRORS)) + 1
+        if stripped.endswith(end):
+            count += 1
+            if (statements and count >= statements) or (size and nbytes >= size):
+                yield commit
+                in_transaction = False
+                count = nbytes = 0
+    if in_transaction:
+        yield commit
+
+
+def logged_order(references):
+    """
+    Orders tables so that each one comes after the tables it references, as ALTER TABLE ... SET LOGGED
+    on a table that references a still unlogged table fails.
+    :param references: OrderedDict of table to set of tables it references
+    :return: list of tables
+    """
+    ordered = []
+    seen = set()
+
+    def visit(table):
+        if table in seen:
+            return
+        seen.add(table)
+        for other in sorted(references.get(table, ())):
+            if other in references:
+                visit(other)
+        ordered.append(table)
+
+    for table in references:
+        visit(table)
+    return ordered
+
+
+def process_raw_line(raw, sqrub, prefix=None, schema=None, encoding='utf-8'):
+    """
+    Processes a raw line of bytes, keeping its original line ending.
+    Row data lines only have \\' replaced and otherwise pass through as raw bytes.
+    Other lines are decoded and handed to process_line; a line process_line
+    cannot transform is passed through unchanged.
+    :param raw: the bytes to work on, including any line ending
+    :param sqrub: an instantiated Sqrubber that has state for attr: indent
+    :param prefix: prefix string to prepend to name
+    :param schema: schema name to prepend to name
+    :param encoding: an ASCII-compatible encoding of the dump
+    :return: transformed bytes
+    """
+    return render_raw_line(parse_raw_line(raw, sqrub, encoding), prefix, schema, encoding)
+
+
+def parse_raw_line(raw, sqrub, encoding='utf-8'):
+    """
+    Parses a raw line of bytes for process_raw_line, leaving out the prefix and schema,
+    so the line can be rendered for several of them with render_raw_line.
+    :param raw: the bytes to work on, including any line ending
+    :param sqrub: an instantiated Sqrubber that has state for attr: indent
+    :param encoding: an ASCII-compatible encoding of the dump
+    :return: transformed bytes if the line has no table names, otherwise a template tuple ending in the line ending
+    """
+    body = raw.rstrip(b'\r\n')
+    ending = raw[len(body):]
+    if DATA_LINE_BYTES.match(body):
+        if body.rstrip().endswith(b');'):
+            sqrub.indent = False
+        return body.replace(b"\\'", b"''") + ending
+    parsed = parse_line(body.decode(encoding, DECODE_ERRORS).strip(), sqrub)
+    if parsed is None:
+        return raw
+    if isinstance(parsed, str):
+        return parsed.encode(encoding, DECODE_ERRORS) + ending
+    return parsed + (ending,)
+
+
+def render_raw_line(parsed, prefix=None, schema=None, encoding='utf-8'):
+    """Renders a line parsed by parse_raw_line for one prefix and schema, as bytes"""
+    if isinstance(parsed, bytes):
+        return parsed
+    return render_line(parsed[:-1], prefix, schema).encode(encoding, DECODE_ERRORS) + parsed[-1]
+
+
+def check_encoding(encoding):
+    """
+    Checks that an encoding exists and is ASCII-compatible, as needed to rewrite
+    identifiers in place on raw bytes.
+    :param encoding: name of the encoding
+    :return: the canonical name of the encoding, or None if it is unusable
+    """
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    probe = 'CREATE TABLE "a_#"(\'x\');\r\n'
+    try:
+        if probe.encode(name) != probe.encode('ascii'):
+            return None
+    except UnicodeError:
+        return None
+    return name
+
+
+def detect_encoding(data: bytes, final=True):
+    """
+    Detects the encoding of the start of a dump from a byte order mark, or by trying UTF-8.
+    :param data: the first bytes of the dump
+    :param final: whether data is the whole dump, if not a sequence cut at the end is allowed
+    :return: name of the encoding, FALLBACK_ENCODING if data is not UTF-8
+    """
+    for bom, name in BOM_ENCODINGS:
+        if data.startswith(bom):
+            return name
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data, final)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    return 'utf-8'
+
+
+def head_lines(lines, max_bytes):
+    """
+    Takes lines from an iterable until max_bytes have been taken.
+    :return: tuple of the lines taken and whether the iterable was exhausted
+    """
+    head, size = [], 0
+    for line in lines:
+        head.append(line)
+        size += len(line)
+        if size >= max_bytes:
+            return head, False
+    return head, True
+
+
+def sniff_input(infile=None, stream=None, doc=None, max_bytes=SNIFF_BYTES, matcher=MATCHER):
+    """
+    Sniffs a bounded prefix of the input of Sqrubber or Collisions, so wrong inputs are rejected
+    and the pipeline configured before the input is read in full.
+    The format is 'sqrubbed' for sqrubber output, 'mdb' for MDB Viewer dumps, 'sql' for other DDL
+    and None without DDL. sections counts the -- SQL Dump of headers in the prefix and complete
+    tells whether the prefix is the whole input.
+    :param infile: path of the input
+    :param stream: file object of the input
+    :param doc: list of lines of the input
+    :param max_bytes: size of the prefix
+    :param matcher: KeywordMatcher used to find DDL
+    :return: tuple of InputSniff and the file object, which still yields the sniffed lines
+    """
+    encoding = None
+    if infile is not None:
+        with open(infile, 'rb') as f:
+            data = f.read(max_bytes + 1)
+        complete = len(data) <= max_bytes
+        encoding = detect_encoding(data[:max_bytes], complete)
+        lines = codecs.getincrementaldecoder(encoding)(DECODE_ERRORS).decode(data[:max_bytes], complete).splitlines()
+        if not complete:
+            lines = lines[:-1]
     else:
-        return ' '.join((name, remain.upper()))
+        head, complete = head_lines(stream if stream is not None else doc or [], max_bytes)
+        if stream is not None:
+            stream = itertools.chain(head, stream)
+        raw = b''.join(line for line in head if isinstance(line, bytes))
+        if raw:
+            encoding = detect_encoding(raw, complete)
+        lines = [line.decode(encoding, DECODE_ERRORS) if isinstance(line, bytes) else line for line in head]
+    dump_format = None
+    has_ddl = False
+    sections = 0
+    for line in lines:
+        lowered = line.strip().lower()
+        if lowered.startswith('-- sqrubber version'):
+            dump_format = 'sqrubbed'
+        elif dump_format is None and lowered.startswith('-- generated by mdb viewer'):
+            dump_format = 'mdb'
+        if lowered.startswith(SQL_DUMP_LINE):
+            sections += 1
+        has_ddl = has_ddl or matcher.has_keyword(line)
+    if dump_format is None and has_ddl:
+        dump_format = 'sql'
+    return InputSniff(dump_format, encoding, has_ddl, sections, complete), stream
 
 
 def add_prefix(name, prefix):
@@ -203,6 +937,77 @@ def add_schema(name, schema):
         return '.'.join((schema, name))
 
 
+def open_input(infile):
+    """
+    Sorts out the input of Sqrubber or Collisions. Byte lines are passed on as a stream, so they are
+    sniffed and decoded as a binary file object would be.
+    :param infile: a path, a file object, or a list or other iterable of str or byte lines
+    :return: tuple of path, file object and list of lines, only one of which is set
+    :raises InvalidInputError: if there is no input or the path is not a file
+    """
+    if isinstance(infile, (str, os.PathLike)):
+        if not os.path.isfile(infile):
+            raise InvalidInputError('Input {} is not a file'.format(infile))
+        return os.fspath(infile), None, None
+    if hasattr(infile, 'read'):
+        return None, infile, None
+    if isinstance(infile, list):
+        doc = infile
+    elif infile is not None and not isinstance(infile, (bytes, bytearray)) and hasattr(infile, '__iter__'):
+        doc = list(infile)
+    else:
+        doc = None
+    if not doc:
+        raise InvalidInputError('No input, expected a path, a file object or lines')
+    if isinstance(doc[0], (bytes, bytearray)):
+        return None, iter(bytes(line) if line.endswith(b'\n') else bytes(line) + b'\n' for line in doc), None
+    return None, None, doc
+
+
+def iter_dump(path, raw=False, encoding=None):
+    """
+    Streams the lines of a dump file in the same way as Sqrubber.read_dump and read_dump_bytes
+    :param path: the path to read from
+    :param raw: yield raw byte lines with their line endings instead of stripped str lines
+    :param encoding: encoding of str lines, stray bytes past a sniffed prefix are kept as is.
+    The platform default if not given.
+    :return: generator of lines
+    """
+    if raw:
+        with open(path, 'rb') as f:
+            yield from f
+        return
+    with open(path, 'r', encoding=encoding, errors=DECODE_ERRORS if encoding else None) as f:
+        for line in f:
+            yield line.strip()
+
+
+def read_stream(stream, encoding=None, text_encoding=None):
+    """
+    Streams a text or binary file object in the same way as Sqrubber.read_dump and read_dump_bytes
+    :param stream: the file object to read from
+    :param encoding: keep raw byte lines in this encoding, or read stripped str lines if None
+    :param text_encoding: encoding to decode binary lines with when reading str lines, UTF-8 if not given
+    :return: generator of lines
+    """
+    for line in stream:
+        if isinstance(line, bytes):
+            yield line if encoding else line.decode(text_encoding or 'utf-8', DECODE_ERRORS).strip()
+        else:
+            yield line.encode(encoding, DECODE_ERRORS) if encoding else line.strip()
+
+
+@contextmanager
+def open_output(target, mode='w', **kwargs):
+    """Opens a path for writing with the open() kwargs, or passes an open file object through without closing it"""
+    if hasattr(target, 'write'):
+        yield target
+        target.flush()
+    else:
+        with open(target, mode, **kwargs) as f:
+            yield f
+
+
 class Sqrubber(object):
     """
     Sqrubber consumes an SQL dump and parses it, cleaning up and transforming the dump
@@ -210,35 +1015,33 @@ class Sqrubber(object):
 
     def __init__(self, infile=None, prefix=None, schema=None):
         """Constructor for Sqrubber
-        :param infile: input file containing an SQL dump to be processed.
+        :param infile: an SQL dump to be processed, as a path, a file object or an iterable of lines.
         :param prefix: a SQL name compliant string to be prepended to all tablenames.
         :param schema: a SQL schema name to use for all tables.
         """
-        if not infile:
-            print("Warning! Your Sqrubber has no input.")
-            try:
-                sys.stdin.close()
-            except SystemError as e:
-                print(e)
-            raise SystemExit()
-        elif isinstance(infile, list):
-            self.infile = None
-            self.doc = infile
-        # FIXME need to be able to test whether type is correct for this.
-        elif os.path.isfile(infile):
-            self.infile = infile
-            self.doc = None
-        else:
-            print("General error...")
-            try:
-                sys.stdin.close()
-            except ValueError as e:
-                print(e)
-            raise SystemExit()
+        self.infile, self.stream, self.doc = open_input(infile)
+        self.outfile = None
+        self.print_only = None
         self.prefix = prefix
         self.schema = schema
         self.version = VERSION
         self.indent = None  # not certain what this was for
+        self.include_tables = []
+        self.exclude_tables = []
+        self.schema_only = False
+        self.encoding = None
+        self.text_encoding = None
+        self.selected = False
+        self.matcher = MATCHER
+        self.profile = None
+        self.sample = None
+        self.sample_fraction = None
+        self.sample_seed = 0
+        self.batch_statements = None
+        self.batch_bytes = None
+        self.synchronous_commit = None
+        self.unlogged = False
+        self.unlogged_tables = OrderedDict()
 
     def __repr__(self):
         """
@@ -249,15 +1052,17 @@ class Sqrubber(object):
                'schema={schema}>'.format(version=self.version, prefix=self.prefix, schema=self.schema)
 
     def destroy(self):
-        """Destructor for Sqrubber"""
-        print("Sqrubber is finished....")
+        """Destructor for Sqrubber, releases the input"""
+        self.doc = None
+        self.stream = None
 
-    def set_schema(self):
+    def set_schema(self, schema=None):
         """
         Writes out a comment in output SQL to remind user of schema assumptions in dump.
+        :param schema: the schema name, defaults to self.schema
         :return:
         """
-        return '\n\n--\n-- Sqrubber is assuming the existence of schema {}\n--\n\n'.format(self.schema)
+        return '\n\n--\n-- Sqrubber is assuming the existence of schema {}\n--\n\n'.format(schema or self.schema)
 
     def validate(self):
         """
@@ -268,33 +1073,171 @@ class Sqrubber(object):
         if not self.doc:
             return False
         for line in self.doc:
+            if self.encoding:
+                line = line.decode(self.encoding, DECODE_ERRORS)
             if self._token_in_line(line):
                 return True
         return False
 
-    @staticmethod
-    def _token_in_line(line):
+    def _token_in_line(self, line):
         """
         checks for DDL token in the line
         :param line: line to check
         :return: True if present, False otherwise
         """
-        if any(token in line.lower() for token in DDL_KEYWORDS):
-            return True
-        return False
+        return self.matcher.has_keyword(line)
+
+    def sniff(self, max_bytes=SNIFF_BYTES):
+        """
+        Sniffs a bounded prefix of the input, see sniff_input.
+        :param max_bytes: size of the prefix
+        :return: an InputSniff
+        """
+        sniff, self.stream = sniff_input(self.infile, self.stream, self.doc, max_bytes, self.matcher)
+        return sniff
+
+    def configure(self, sniff):
+        """
+        Chooses the decoder from a sniff of the input, unless an encoding was set: dumps that are
+        not UTF-8 are processed as raw bytes in FALLBACK_ENCODING, others are decoded as sniffed.
+        :param sniff: an InputSniff
+        :return:
+        """
+        if self.encoding or sniff.encoding is None or self.doc is not None:
+            return
+        if sniff.encoding == FALLBACK_ENCODING:
+            self.encoding = sniff.encoding
+        else:
+            self.text_encoding = sniff.encoding
+
+    def load(self):
+        """
+        Reads the input path or file object into self.doc, unless a list of lines was given.
+        Tables are selected and rows sampled while reading, so only kept lines are held in memory.
+        Lines are raw bytes if self.encoding is set, stripped str otherwise.
+        :return: the list of lines
+        """
+        if self.infile is not None:
+            lines = iter_dump(self.infile, bool(self.encoding), self.text_encoding)
+        elif self.stream is not None:
+            lines = read_stream(self.stream, self.encoding, self.text_encoding)
+            self.stream = None
+        else:
+            return self.doc
+        self.doc = list(self.select(lines))
+        self.selected = True
+        return self.doc
+
+    def select(self, lines):
+        """
+        Applies the table selection, schema-only and sampling options to lines, see filter_lines and sample_lines.
+        :param lines: iterable of lines
+        :return: generator of the lines to keep
+        """
+        lines = filter_lines(lines, self, self.encoding)
+        if self.sample is not None or self.sample_fraction is not None:
+            lines = sample_lines(lines, self, self.encoding)
+        return lines
+
+    def run(self, outfile=None, load_order=False):
+        """
+        Loads, validates and transforms the input, then writes the result.
+        :param outfile: path or file object to write to, ignored if print_only is set. If neither is given
+        the output lines are only returned.
+        :param load_order: emit statements in load-optimized order, see reorder_for_load.
+        :return: the list of output lines
+        :raises InvalidInputError: if the input holds no DDL or is already sqrubbed
+        """
+        return self.run_targets([(self.prefix, self.schema, outfile)], load_order)[0]
+
+    def run_targets(self, targets, load_order=False):
+        """
+        Loads, validates and transforms the input once for several targets, then writes an output for each.
+        Tables are selected as in transform_targets.
+        :param targets: list of (prefix, schema, outfile) tuples, outfile a path or file object, or None to
+        only return the output lines.
+        :param load_order: emit statements in load-optimized order, see reorder_for_load.
+        :return: list of the output lines of each target
+        :raises InvalidInputError: if the input holds no DDL or is already sqrubbed
+        """
+        sniff = self.sniff()
+        if not sniff.has_ddl:
+            raise InvalidInputError('Input is not DDL, please check input')
+        # names in sqrubber output are standardized already, a second pass would prefix them again
+        if sniff.format == 'sqrubbed':
+            raise InvalidInputError('Input is already sqrubbed, please check input')
+        self.configure(sniff)
+        self.prefix, self.schema = targets[0][:2] if len(targets) == 1 else (None, None)
+        self.load()
+        outputs = self.transform_targets([(prefix, schema) for prefix, schema, outfile in targets], load_order)
+        for (prefix, schema, outfile), output in zip(targets, outputs):
+            if outfile is not None or self.print_only:
+                self.write_dump(outfile, output)
+        return outputs
+
+    def transform(self, load_order=False):
+        """
+        Filters, samples and standardizes the lines in self.doc.
+        :param load_order: emit statements in load-optimized order, see reorder_for_load.
+        :return: the list of output lines, raw bytes if self.encoding is set
+        """
+        return self.transform_targets([(self.prefix, self.schema)], load_order)[0]
+
+    def transform_targets(self, targets, load_order=False):
+        """
+        Filters, samples and standardizes the lines in self.doc for several prefix and schema targets.
+        Lines already selected by load are not filtered again.
+        Each line is parsed once and only its table names are rendered per target, so lines without
+        table names, e.g. all rows of data, are shared between the outputs.
+        With several targets tables are selected by their names without prefix and schema, so every
+        output holds the same tables, and the profile is kept for the first target.
+        :param targets: list of (prefix, schema) tuples
+        :param load_order: emit statements in load-optimized order, see reorder_for_load.
+        :return: list of the output lines of each target, raw bytes if self.encoding is set
+        """
+        outputs = []
+        for prefix, schema in targets:
+            output = []
+            if schema:
+                schema_comment = self.set_schema(schema)
+                output.append(schema_comment.encode(self.encoding) if self.encoding else schema_comment)
+            outputs.append(output)
+        self.prefix, self.schema = targets[0] if len(targets) == 1 else (None, None)
+        lines = self.doc if self.selected else self.select(self.doc)
+        self.indent = False
+        for line in lines:
+            if self.encoding:
+                parsed = parse_raw_line(line, self, self.encoding)
+                for output, (prefix, schema) in zip(outputs, targets):
+                    output.append(render_raw_line(parsed, prefix, schema, self.encoding))
+            else:
+                parsed = parse_line(line, self)
+                for output, (prefix, schema) in zip(outputs, targets):
+                    output.append(render_line(parsed, prefix, schema))
+            if self.profile:
+                self.profile.observe(outputs[0][-1])
+        if load_order:
+            outputs = [reorder_for_load(output, self.encoding) for output in outputs]
+        return outputs
 
     @staticmethod
-    def read_dump(path):
+    def read_dump(path, encoding=None):
         """
         Takes a path and reads in a dump file for processing
         :param path: the path to read from
+        :param encoding: encoding of the dump, the platform default if not given
         :return: a list of lines in file
         """
-        data = []
-        with open(path, 'r') as f:
-            for line in f:
-                data.append(line.strip())
-        return data
+        return list(iter_dump(path, encoding=encoding))
+
+    @staticmethod
+    def read_dump_bytes(path):
+        """
+        Takes a path and reads in a dump file as raw bytes, keeping line endings
+        :param path: the path to read from
+        :return: a list of raw lines in file
+        """
+        return list(iter_dump(path, raw=True))
 
     @staticmethod
     def write_meta():
@@ -306,28 +1249,100 @@ class Sqrubber(object):
                 VALUES('NOM', 'SRC', 'DESCR', 1, 'shawn');\n\n"""
         return s
 
+    def session_preamble(self):
+        """
+        Writes out the session settings for the load, placed right after the header comments.
+        :return:
+        """
+        if not self.synchronous_commit:
+            return ''
+        return '--\n-- Sqrubber load session settings\n--\n' \
+               'SET synchronous_commit = {};\n\n'.format(self.synchronous_commit)
+
+    def session_postamble(self):
+        """
+        Writes out the statements that finish the load session, switching unlogged tables to logged.
+        :return:
+        """
+        if not self.unlogged_tables:
+            return ''
+        return '\n--\n-- Sqrubber switching unlogged tables to logged\n--\n' + \
+               ''.join('ALTER TABLE {} SET LOGGED;\n'.format(t) for t in logged_order(self.unlogged_tables))
+
+    def prepare_output(self, output):
+        """
+        Applies the load session options to the output: creates tables as UNLOGGED, recording
+        them and the tables they reference for session_postamble, and batches statements into transactions.
+        :param output: the output lines, raw byte lines if self.encoding is set
+        :return: generator of output lines
+        """
+        self.unlogged_tables = OrderedDict()
+        lines = self._unlog_tables(output) if self.unlogged else output
+        if self.batch_statements or self.batch_bytes:
+            lines = batch_transactions(lines, self.batch_statements, self.batch_bytes, self.encoding)
+        return lines
+
+    def _unlog_tables(self, output):
+        """Rewrites CREATE TABLE as CREATE UNLOGGED TABLE, recording tables and their references"""
+        create, unlogged = 'CREATE TABLE ', 'CREATE UNLOGGED TABLE '
+        table = None
+        for line in output:
+            text = line.decode(self.encoding, DECODE_ERRORS) if self.encoding else line
+            if text.startswith(create):
+                table = text[len(create):].split('(', 1)[0].strip()
+                self.unlogged_tables[table] = set()
+                text = unlogged + text[len(create):]
+                line = text.encode(self.encoding, DECODE_ERRORS) if self.encoding else text
+            elif text.startswith('ALTER TABLE '):
+                table = text[len('ALTER TABLE '):].split(' ', 1)[0]
+            for match in REFERENCES_PATTERN.finditer(text):
+                if table in self.unlogged_tables:
+                    self.unlogged_tables[table].add(match.group(2))
+            if text.strip().endswith(';'):
+                table = None
+            yield line
+
     def write_dump(self, path, output):
         """
         Takes the content of sqrubber object and writes it to a file
         :param output: the output to write out
-        :param path: the path to write to
+        :param path: the path or text file object to write to
         :return:
         """
-        if self.print_only:
-            # FIXME this should probably turn into a cmd line flag and even break out from a conf file....
-            print(self.write_meta())
-            print("-- Sqrubber version {version}\n".format(version=self.version))
-            print("-- Sqrubber output generated on " + str(datetime.datetime.now()) + 3 * "\n")
-            for line in output:
-                print(line)
-            print("\n\n-- Sqrubber job finished")
-            return
-        with open(path, 'w') as f:
+        if self.encoding:
+            return self.write_dump_bytes(path, output)
+        errors = DECODE_ERRORS if self.text_encoding else None
+        with open_output(sys.stdout if self.print_only else path, 'w', errors=errors) as f:
+            if self.print_only:
+                f.write(self.write_meta() + '\n')
             f.write("-- Sqrubber version {version}\n".format(version=self.version))
             f.write("-- Sqrubber output generated on " + str(datetime.datetime.now()) + 3*"\n")
-            for line in output:
+            f.write(self.session_preamble())
+            for line in self.prepare_output(output):
                 f.write(line + '\n')
+            f.write(self.session_postamble())
             f.write("\n\n-- Sqrubber job finished")
+            if self.print_only:
+                f.write('\n')
+
+    def write_dump_bytes(self, path, output):
+        """
+        Writes raw byte lines, which already carry their line endings, with the usual header and footer
+        :param output: the raw lines to write out
+        :param path: the path or binary file object to write to
+        :return:
+        """
+        header = "-- Sqrubber version {version}\n".format(version=self.version) + \
+                 "-- Sqrubber output generated on " + str(datetime.datetime.now()) + 3*"\n"
+        footer = "\n\n-- Sqrubber job finished"
+        with open_output(sys.stdout.buffer if self.print_only else path, 'wb') as f:
+            if self.print_only:
+                f.write(self.write_meta().encode(self.encoding))
+            f.write((header + self.session_preamble()).encode(self.encoding))
+            f.writelines(self.prepare_output(output))
+            f.write((self.session_postamble() + footer).encode(self.encoding))
+            if self.print_only:
+                f.write(b'\n')
 
 
 def usage():
@@ -337,7 +1352,11 @@ def usage():
     """
     output = 'usage: sqrubber -[hpio] [-h help] [-p print-output-only] ' \
              '[--prefix=<prefix>] [--schema=<schema_name>]' \
-             '[-i/--infile=<inputfile>] [-o/--outfile=<outputfile>]'
+             '[--include-table=<pattern>] [--exclude-table=<pattern>] [--schema-only]' \
+             '[--encoding=<encoding>] [--add-type=<column_type>] [--profile=<reportfile>]' \
+             '[--sample=<rows> | --sample-fraction=<fraction>] [--load-order]' \
+             '[--batch-statements=<count>] [--batch-bytes=<bytes>] [--synchronous-commit=<setting>] [--unlogged]' \
+             '[--target=<prefix>:<schema>:<outputfile>] [-i/--infile=<inputfile>] [-o/--outfile=<outputfile>]'
     return output
 
 
@@ -347,12 +1366,29 @@ def main(argv):
     :param argv:
     :return:
     """
+    infile = None
     print_only = None
     outfile = None
     prefix = None
     schema = None
+    include_tables = []
+    exclude_tables = []
+    schema_only = False
+    encoding = None
+    add_types = []
+    profile_path = None
+    sample = None
+    sample_fraction = None
+    load_order = False
+    session = {}
+    targets = []
     try:
-        options, remainder = getopt.gnu_getopt(argv, 'hpi:o:', ['print', 'infile=', 'outfile=', 'prefix=', 'schema='])
+        options, remainder = getopt.gnu_getopt(argv, 'hpi:o:', ['print', 'infile=', 'outfile=', 'prefix=', 'schema=',
+                                                               'include-table=', 'exclude-table=', 'schema-only',
+                                                               'encoding=', 'add-type=', 'profile=', 'sample=',
+                                                               'sample-fraction=', 'load-order', 'batch-statements=',
+                                                               'batch-bytes=', 'synchronous-commit=', 'unlogged',
+                                                               'target='])
     except getopt.GetoptError:
         print("Error. Proper usage is " + usage())
         sys.exit(2)
@@ -364,7 +1400,7 @@ def main(argv):
             print("Proper usage is " + usage())
             sys.exit()
         elif opt in ['-i', '--infile']:
-            sqrub = Sqrubber(arg)
+            infile = arg
         elif opt in ['-o', '--outfile']:
             outfile = arg
         elif opt in ['-p', '--print']:
@@ -373,27 +1409,81 @@ def main(argv):
             prefix = arg
         elif opt in ['--schema']:
             schema = arg
+        elif opt in ['--include-table']:
+            include_tables.append(arg)
+        elif opt in ['--exclude-table']:
+            exclude_tables.append(arg)
+        elif opt in ['--schema-only']:
+            schema_only = True
+        elif opt in ['--encoding']:
+            encoding = check_encoding(arg)
+            if encoding is None:
+                print("Error. Encoding {} is unknown or not ASCII-compatible".format(arg))
+                sys.exit(2)
+        elif opt in ['--add-type']:
+            add_types.append(arg)
+        elif opt in ['--profile']:
+            profile_path = arg
+        elif opt in ['--sample']:
+            sample = int(arg)
+        elif opt in ['--sample-fraction']:
+            sample_fraction = float(arg)
+        elif opt in ['--load-order']:
+            load_order = True
+        elif opt in ['--batch-statements']:
+            session['batch_statements'] = int(arg)
+        elif opt in ['--batch-bytes']:
+            session['batch_bytes'] = int(arg)
+        elif opt in ['--synchronous-commit']:
+            session['synchronous_commit'] = arg
+        elif opt in ['--unlogged']:
+            session['unlogged'] = True
+        elif opt in ['--target']:
+            target = arg.split(':', 2)
+            if len(target) != 3 or not target[2]:
+                print("Error. Target {} is not <prefix>:<schema>:<outputfile>".format(arg))
+                sys.exit(2)
+            targets.append((target[0] or None, target[1] or None, target[2]))
+    if targets and (outfile or prefix or schema or print_only):
+        print("Error. --target sets the prefix, schema and output file, "
+              "it cannot be combined with -o, -p, --prefix or --schema")
+        sys.exit(2)
+    try:
+        sqrub = Sqrubber(infile, prefix, schema)
+    except InvalidInputError as e:
+        print("Error. {}".format(e))
+        sys.exit(2)
     sqrub.outfile = outfile
     sqrub.print_only = print_only
-    if sqrub.infile:
-        sqrub.doc = sqrub.read_dump(sqrub.infile)
-    if not sqrub.validate():
+    sqrub.include_tables = include_tables
+    sqrub.exclude_tables = exclude_tables
+    sqrub.schema_only = schema_only
+    sqrub.encoding = encoding
+    sqrub.sample = sample
+    sqrub.sample_fraction = sample_fraction
+    for attr, value in session.items():
+        setattr(sqrub, attr, value)
+    if add_types:
+        sqrub.matcher = sqrub.matcher.add_types(add_types)
+    if profile_path:
+        # imported here, as profiling takes its constants from this module
+        try:
+            from .profiling import DumpProfile
+        except ImportError:
+            from profiling import DumpProfile
+        sqrub.profile = DumpProfile(encoding or 'utf-8')
+    try:
+        if targets:
+            sqrub.run_targets(targets, load_order)
+        else:
+            sqrub.run(sqrub.outfile, load_order)
+    except InvalidInputError:
         print("Input is not DDL, please check input....")
-        exit()
-    output = []
-    if schema:
-        sqrub.schema = schema
-        output.append(sqrub.set_schema())
-    if prefix:
-        sqrub.prefix = prefix
-    for index, line in enumerate(sqrub.doc):
-        if index == 0:
-            sqrub.indent = False
-        print(line)
-        output.append(process_line(line, sqrub, sqrub.prefix, sqrub.schema))
-    sqrub.write_dump(sqrub.outfile, output)
+        sys.exit(1)
+    if sqrub.profile:
+        sqrub.profile.write(profile_path)
     sqrub.destroy()
-
+    print("Sqrubber is finished....")
 
 if __name__ == '__main__':
     main(sys.argv[1:])
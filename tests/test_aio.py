@@ -0,0 +1,80 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# unit test class for the asyncio API
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# standard libs
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+# 3rd party libs
+import pytest
+
+# application libs
+import aio
+import sqrubber as sq
+
+
+async def chunks(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def collect(agen):
+    return [line async for line in agen]
+
+
+def test_iter_lines_rejoins_chunks():
+    data = 'DROP TABLE a;\r\nCREATE TABLE café (\n'.encode('utf-8')
+    assert ['DROP TABLE a;', 'CREATE TABLE café ('] == asyncio.run(collect(aio.iter_lines(chunks(data, 3))))
+
+
+async def items(lines):
+    for line in lines:
+        yield line
+
+
+def test_iter_lines_whole_lines():
+    lines = ['DROP TABLE "a b";', 'DROP TABLE "c d";\n', 'CREATE TABLE café ('.encode('utf-8')]
+    assert ['DROP TABLE "a b";', 'DROP TABLE "c d";', 'CREATE TABLE café ('] == \
+        asyncio.run(collect(aio.iter_lines(items(lines), lines=True)))
+    out = asyncio.run(collect(aio.scrub_lines(items(lines[:2]), lines=True)))
+    assert ['DROP TABLE a_b;', 'DROP TABLE c_d;'] == out
+
+
+def test_scrub_lines():
+    data = '-- dump\nDROP TABLE former employees;\nCREATE TABLE "R&I Trend" (\n"Store #" INTEGER\n);\n'
+    out = asyncio.run(collect(aio.scrub_lines(chunks(data, 7), prefix='t', batch_size=2)))
+    assert ['-- dump', 'DROP TABLE t_former_employees;', 'CREATE TABLE t_r_and_i_trend (',
+            '     store_num INTEGER', ');'] == out
+
+
+def test_scrub_lines_process_executor():
+    data = 'DROP TABLE a;\nCREATE TABLE "R&I Trend" (\n"Store #" INTEGER,\n"Item" TEXT\n);\n'
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        out = asyncio.run(collect(aio.scrub_lines(chunks(data, 7), batch_size=1, executor=executor)))
+    assert ['DROP TABLE a;', 'CREATE TABLE r_and_i_trend (', '     store_num INTEGER,', '     item TEXT',
+            ');'] == out
+
+
+def test_scrub_lines_rejects_non_sql():
+    with open('lorem.txt', 'rb') as f:
+        data = f.read()
+    with pytest.raises(sq.InvalidInputError):
+        asyncio.run(collect(aio.scrub_lines(chunks(data, 64))))
+
+
+def test_collide_lines():
+    with open('multiple-example.sql', 'rb') as f:
+        data = f.read()
+    out = asyncio.run(collect(aio.collide_lines(chunks(data, 4096))))
+    assert out[79] == 'DROP TABLE IF EXISTS myschema.der_all_brands_price_data_d_2;'
+
+
+def test_collide_lines_rejects_non_sql():
+    with open('lorem.txt', 'rb') as f:
+        data = f.read()
+    with pytest.raises(sq.InvalidInputError):
+        asyncio.run(collect(aio.collide_lines(chunks(data, 64))))
@@ -6,12 +6,36 @@
 #  -*- coding: utf-8 -*-
 
 # standard libs
+import io
 
 # 3rd party libs
 import pytest
 
 # application libs
 import collisions as coll
+import sqrubber as sq
+
+
+KEYS_DUMP = ['-- SQL Dump of {}.mdb', 'DROP TABLE IF EXISTS "Customers";', 'CREATE TABLE "Customers" (',
+             '"ID" INTEGER PRIMARY KEY,', '"Name" TEXT UNIQUE', ');',
+             'INSERT INTO "Customers"("ID","Name")', "VALUES(1,E'a'),", "(2,E'b');",
+             'DROP TABLE IF EXISTS "Orders";', 'CREATE TABLE "Orders" (', '"Order ID" INTEGER,',
+             '"Cust ID" INTEGER REFERENCES "Customers"("ID")', ');',
+             'CREATE INDEX "Cust Idx" ON "Orders" ("Cust ID");',
+             'INSERT INTO "Orders"("Order ID","Cust ID")', 'VALUES(1,2);']
+
+
+def sqrubbed_dump(names, load_order=False, **options):
+    """Sqrubs the same dump once per SQL dump name with the same prefix and combines the outputs"""
+    combined = []
+    for name in names:
+        sqrub = sq.Sqrubber([line.format(name) for line in KEYS_DUMP], prefix='db')
+        for option, value in options.items():
+            setattr(sqrub, option, value)
+        out = io.StringIO()
+        sqrub.run(out, load_order)
+        combined.extend(line.strip() for line in out.getvalue().splitlines())
+    return combined
 
 
 @pytest.mark.skip('Collisions object failing on tests')
@@ -81,3 +105,183 @@ def test_orphan_create_table(cs_orphan_create_sql):
 def test_make_suffix(cs_sql):
     assert cs_sql.make_suffix('wilkes_barre_report_fall_2016', 1) == \
         'wbrf_2016'
+
+
+def test_indexed_rewrite_matches_in_memory(cs_sql, tmp_path):
+    cs_sql.make_sql_dump_suffixes()
+    for line in cs_sql.doc:
+        coll.find_dupes(line, cs_sql)
+    for idx, line in enumerate(cs_sql.doc):
+        cs_sql.process_dupes(line, idx)
+    index = coll.CollisionsIndex(str(tmp_path / 'index.sqlite3'))
+    assert index.build(cs_sql.infile) == 16
+    assert index.suffixes() == cs_sql.suffixes
+    assert list(index.rewrite(cs_sql.infile)) == cs_sql.doc
+    index.close()
+
+
+def test_get_sections(cs_sql):
+    sections = cs_sql.get_sections()
+    assert [name for name, start, end in sections] == [None, 'db_1', 'db_2', 'atlanta_report', 'albany_report',
+                                                       'alltown_report']
+    assert sections[2][1:] == (73, 125)
+    assert sections[-1][2] == len(cs_sql.doc)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_process_dupes_parallel_matches_serial(cs_sql, jobs):
+    cs_sql.make_sql_dump_suffixes()
+    for line in cs_sql.doc:
+        coll.find_dupes(line, cs_sql)
+    for idx, line in enumerate(cs_sql.doc):
+        cs_sql.process_dupes(line, idx)
+    serial = cs_sql.doc
+    cs_sql.doc = cs_sql.read_dump(cs_sql.infile)
+    cs_sql.process_dupes_parallel(jobs)
+    assert cs_sql.doc == serial
+
+
+def test_merge_identical_tables(cs_sql):
+    cs_sql.make_sql_dump_suffixes()
+    merged = cs_sql.merge_identical_tables()
+    assert merged['myschema.der_all_brands_transposed'] == ['db_1', 'db_2']
+    assert len(merged['myschema.der_all_brands_price_data']) == 5
+    assert sum(line.startswith('CREATE TABLE myschema.der_all_brands_price_data (') for line in cs_sql.doc) == 1
+    assert 'source_dump TEXT' in cs_sql.doc
+    assert cs_sql.doc[cs_sql.doc.index('source_dump TEXT') - 1] == 'date TEXT,'
+    inserts = [line for line in cs_sql.doc if line.startswith('INSERT INTO myschema.der_all_brands_price_data')]
+    assert all(line.endswith(', date, source_dump)') for line in inserts)
+    assert any(line.endswith("E'March 2013','albany_report');") for line in cs_sql.doc)
+    # nothing left for the suffixing pass
+    for line in cs_sql.doc:
+        coll.find_dupes(line, cs_sql)
+    assert not any(count > 1 for count in cs_sql.names.values())
+
+
+def test_merge_suffixes_divergent_tables(cs_sql):
+    cs_sql.make_sql_dump_suffixes()
+    start, end = cs_sql.get_sections()[2][1:]
+    idx = cs_sql.doc.index('price DOUBLE PRECISION,', start, end)
+    cs_sql.doc[idx] = 'price NUMERIC,'
+    merged = cs_sql.merge_identical_tables()
+    assert merged['myschema.der_all_brands_price_data'] == ['db_1', 'atlanta_report', 'albany_report',
+                                                           'alltown_report']
+    assert 'CREATE TABLE myschema.der_all_brands_price_data_d_2 (' in cs_sql.doc
+    assert 'INSERT INTO myschema.der_all_brands_price_data_d_2 (market, name, store_num, category, item, ' \
+           'size_or_quantity, price, date)' in cs_sql.doc
+
+
+def test_merge_groups_identical_definitions(cs_sql):
+    cs_sql.make_sql_dump_suffixes()
+    for number in [2, 3]:
+        start, end = cs_sql.get_sections()[number][1:]
+        idx = cs_sql.doc.index('price DOUBLE PRECISION,', start, end)
+        cs_sql.doc[idx] = 'price NUMERIC,'
+    merged = cs_sql.merge_identical_tables()
+    assert merged['myschema.der_all_brands_price_data'] == ['db_1', 'albany_report', 'alltown_report']
+    assert merged['myschema.der_all_brands_price_data_d_2'] == ['db_2', 'atlanta_report']
+    assert cs_sql.doc.count('CREATE TABLE myschema.der_all_brands_price_data_d_2 (') == 1
+    assert not any(line.startswith('CREATE TABLE myschema.der_all_brands_price_data_ar') for line in cs_sql.doc)
+    assert any(line.endswith("'atlanta_report');") for line in cs_sql.doc)
+    inserts = [line for line in cs_sql.doc if line.startswith('INSERT INTO myschema.der_all_brands_price_data_d_2 ')]
+    assert len(inserts) == 4 and all(line.endswith(', date, source_dump)') for line in inserts)
+
+
+def test_library_run_without_side_effects(capsys):
+    out = io.StringIO()
+    with open('multiple-example.sql') as source:
+        doc = coll.Collisions(source).run(out)
+    assert 'CREATE TABLE myschema.der_all_brands_price_data_d_2 (' in doc
+    assert 'CREATE TABLE myschema.der_all_brands_price_data_d_2 (\n' in out.getvalue()
+    # without an output the lines are only returned
+    assert coll.Collisions('multiple-example.sql').run() == doc
+    assert capsys.readouterr().out == ''
+    with pytest.raises(coll.InvalidInputError):
+        coll.Collisions(doc).run_indexed(outfile=io.StringIO())
+    with pytest.raises(coll.InvalidOutputError):
+        coll.Collisions('multiple-example.sql').run_indexed()
+
+
+def test_library_byte_lines():
+    dump = [line.encode('utf-8') for line in sqrubbed_dump(['db_1', 'db_2'])]
+    doc = coll.Collisions(dump).run()
+    assert 'CREATE TABLE db_customers_d_2 (' in doc and all(isinstance(line, str) for line in doc)
+
+
+def test_sections_from_sniff(monkeypatch):
+    dump = [line for line in sqrubbed_dump(['db_1']) if not line.lower().startswith(sq.SQL_DUMP_LINE)]
+
+    def scan(self):
+        raise AssertionError('scanned for SQL dump sections')
+    monkeypatch.setattr(coll.Collisions, 'make_sql_dump_suffixes', scan)
+    assert coll.Collisions(dump).run() == dump
+
+
+def test_index_file_reused(cs_sql, tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    for infile in [cs_sql.infile, cs_sql.infile, 'orphan_create_table.sql']:
+        fresh = coll.CollisionsIndex()
+        index = coll.CollisionsIndex(path)
+        assert index.build(infile) == fresh.build(infile)
+        assert index.suffixes() == fresh.suffixes()
+        assert list(index.rewrite(infile)) == list(fresh.rewrite(infile))
+        index.close()
+        fresh.close()
+
+
+def test_load_order_dump(tmp_path):
+    dump = sqrubbed_dump(['db_1', 'db_2'], load_order=True)
+    collisions = coll.Collisions(dump)
+    collisions.outfile = io.StringIO()
+    doc = collisions.run()
+    assert 'INSERT INTO db_customers_d_1 (id, name)' in doc
+    assert 'ALTER TABLE db_customers_d_2 ADD PRIMARY KEY (id);' in doc
+    assert 'ALTER TABLE db_orders_d_2 ADD FOREIGN KEY (cust_id) REFERENCES db_customers_d_2(id);' in doc
+    assert 'CREATE INDEX db_cust_idx_d_1 ON db_orders_d_1 (cust_id);' in doc
+    path = tmp_path / 'combined.sql'
+    path.write_text('\n'.join(dump) + '\n')
+    indexed = coll.Collisions(str(path))
+    indexed.outfile = io.StringIO()
+    indexed.run_indexed()
+    assert indexed.outfile.getvalue().splitlines()[2:] == collisions.outfile.getvalue().splitlines()[2:]
+    merging = coll.Collisions(dump)
+    merging.outfile = io.StringIO()
+    doc = merging.run(merge_identical=True)
+    # keys come after the rows of every merged dump and cover the source column
+    last_row = doc.index("VALUES(1,2,'db_2');")
+    assert doc.index('ALTER TABLE db_customers ADD PRIMARY KEY (id, source_dump);') > last_row
+    assert doc.index('ALTER TABLE db_orders ADD FOREIGN KEY (cust_id, source_dump) '
+                     'REFERENCES db_customers(id, source_dump);') > last_row
+    assert doc.index('CREATE INDEX db_cust_idx ON db_orders (cust_id);') > last_row
+    assert not any(line.startswith('ALTER TABLE') and 'source_dump' not in line for line in doc)
+
+
+@pytest.mark.parametrize('load_order', [False, True])
+def test_unlogged_dump(load_order):
+    dump = sqrubbed_dump(['db_1', 'db_2'], load_order, unlogged=True)
+    collisions = coll.Collisions(dump)
+    collisions.outfile = io.StringIO()
+    doc = collisions.run()
+    assert 'CREATE UNLOGGED TABLE db_customers_d_1 (' in doc
+    assert 'INSERT INTO db_orders_d_2 (order_id, cust_id)' in doc
+    assert 'ALTER TABLE db_orders_d_2 SET LOGGED;' in doc
+    assert not any(' db_customers ' in line or ' db_orders ' in line for line in doc)
+    merging = coll.Collisions(dump)
+    merging.outfile = io.StringIO()
+    doc = merging.run(merge_identical=True)
+    assert doc.count('CREATE UNLOGGED TABLE db_orders (') == 1
+    assert doc.index('ALTER TABLE db_orders SET LOGGED;') > doc.index("VALUES(1,2,'db_2');")
+    assert ('PRIMARY KEY (id, source_dump),' in doc) is not load_order
+
+
+def test_late_stray_byte(tmp_path):
+    path = tmp_path / 'late.sql'
+    rows = b'    VALUES(1,2),\n' * (sq.SNIFF_BYTES // 16 + 1)
+    path.write_bytes(open('multiple-example.sql', 'rb').read() + b'INSERT INTO a (x, y)\n' + rows +
+                     b"    VALUES(3,E'caf\xe9');\n")
+    out = tmp_path / 'out.sql'
+    doc = coll.Collisions(str(path)).run(str(out))
+    assert 'CREATE TABLE myschema.der_all_brands_price_data_d_2 (' in doc
+    assert out.read_bytes().endswith(b"\nVALUES(3,E'caf\xe9');\n")
+    coll.Collisions(str(path)).run_indexed(outfile=str(out))
+    assert out.read_bytes().endswith(b"\nVALUES(3,E'caf\xe9');\n")
@@ -0,0 +1,77 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# unit test class for dedupe module
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# standard libs
+
+# 3rd party libs
+import pytest
+
+# application libs
+import dedupe
+
+
+LINES = ['CREATE TABLE s.t (',
+         'a INTEGER,',
+         'b TEXT',
+         ');',
+         'INSERT INTO s.t (a, b)',
+         "VALUES(1,E'x'),",
+         "(2,E'y');",
+         'INSERT INTO s.t (a, b)',
+         "VALUES(1,E'x'),",
+         "(3,E'z'),",
+         "(2,E'y');",
+         'INSERT INTO s.u (a, b)',
+         "VALUES(1,E'x');",
+         'INSERT INTO s.t (a, b)',
+         "VALUES(2,E'y');"]
+
+
+def test_row_values():
+    assert dedupe.row_values("  VALUES(1,E'x'),") == "(1,E'x')"
+    assert dedupe.row_values("(1,E'x','db_2');", drop_last=True) == "(1,E'x')"
+
+
+@pytest.mark.parametrize('memory_rows, bloom_bits', [(1000, 0), (1, 0), (1, 1024)])
+def test_dedupe_rows(memory_rows, bloom_bits, tmp_path):
+    deduper = dedupe.RowDeduper(memory_rows, bloom_bits, str(tmp_path))
+    out = list(dedupe.dedupe_rows(LINES, deduper))
+    assert out == LINES[:7] + ['INSERT INTO s.t (a, b)', "VALUES(3,E'z');", 'INSERT INTO s.u (a, b)', "VALUES(1,E'x');"]
+    assert deduper.report() == [('s.t', 6, 3), ('s.u', 1, 0)]
+    deduper.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_bloom_filter():
+    bloom = dedupe.BloomFilter(4096)
+    digests = [dedupe.row_digest('t', str(i)) for i in range(100)]
+    for digest in digests[:50]:
+        bloom.add(digest)
+    assert all(digest in bloom for digest in digests[:50])
+    assert sum(digest in bloom for digest in digests[50:]) < 5
+
+
+def test_digest_table():
+    table = dedupe.DigestTable(slots=4)
+    digests = [dedupe.row_digest('t', str(i)) for i in range(100)] + [0]
+    for digest in digests + digests[:10]:
+        table.add(digest)
+    assert len(table) == 101 and table.slots == 256
+    assert all(digest in table for digest in digests)
+    assert dedupe.row_digest('t', 'new') not in table
+    assert sorted(table) == sorted(digests)
+
+
+def test_dedupe_merged_tables(cs_sql):
+    cs_sql.make_sql_dump_suffixes()
+    source_tables = set(cs_sql.merge_identical_tables())
+    deduper = dedupe.RowDeduper()
+    list(dedupe.dedupe_rows(cs_sql.doc, deduper, source_tables))
+    dropped = dict((table, dropped) for table, rows, dropped in deduper.report())
+    # the Atlanta rows of DB_2 are exported again in ATLANTA_REPORT
+    assert dropped['myschema.der_all_brands_price_data'] == 10
+    assert dropped['myschema.der_all_brands_transposed'] == 0
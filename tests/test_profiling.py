@@ -0,0 +1,47 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# unit test class for dump profiling
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# standard libs
+import csv
+import json
+
+# 3rd party libs
+import pytest
+
+# application libs
+import profiling as prof
+
+
+def test_profile_collisions_input(cs_sql):
+    profile = prof.DumpProfile()
+    for line in cs_sql.doc:
+        profile.observe(line)
+    report = profile.as_dict()
+    assert report['total_rows'] == 61
+    assert report['tables']['myschema.der_all_brands_price_data']['rows'] == 45
+    assert report['tables']['myschema.der_category_master']['widest_row'] == 107
+    assert report['sections']['db_2']['rows'] == 17
+    assert sum(s['share'] for s in report['sections'].values()) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_profile_bytes_lines():
+    profile = prof.DumpProfile('latin-1')
+    for line in [b'INSERT INTO caf\xe9 (id)\r\n', b'    VALUES(1, E\'\xff\'),\r\n', b'          (22);\r\n',
+                 b'CREATE TABLE x (\r\n', b'    (3, 4)\r\n']:
+        profile.observe(line)
+    assert profile.as_dict()['tables'] == {'caf\xe9': {'rows': 2, 'bytes': 21, 'widest_row': 16}}
+
+
+def test_profile_write(tmp_path):
+    profile = prof.DumpProfile()
+    for line in ['-- SQL Dump of DB_1.mdb', 'INSERT INTO t (id)', 'VALUES(1);']:
+        profile.observe(line)
+    profile.write(str(tmp_path / 'report.json'))
+    profile.write(str(tmp_path / 'report.csv'))
+    assert json.load(open(str(tmp_path / 'report.json')))['sections']['db_1']['share'] == 1.0
+    rows = list(csv.DictReader(open(str(tmp_path / 'report.csv'))))
+    assert [(r['kind'], r['name'], r['rows']) for r in rows] == [('table', 't', '1'), ('section', 'db_1', '1')]
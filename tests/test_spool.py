@@ -0,0 +1,61 @@
+###########################################################
+# Copyright (C) 2015-2018 Shawn Mehan <shawn dot mehan at shawnmehan dot com>
+# unit test class for the spool watcher
+###########################################################
+#
+#  -*- coding: utf-8 -*-
+
+# standard libs
+import json
+import shutil
+
+# 3rd party libs
+
+# application libs
+import spool
+
+RAW_DUMP = '''-- SQL Dump of DB_1.mdb
+
+DROP TABLE IF EXISTS "Price Data";
+
+CREATE TABLE "Price Data" (
+     "Store #" INTEGER,
+     "Item" TEXT
+);
+
+INSERT INTO "Price Data"("Store #","Item")
+    VALUES(478,E'Coffee'),
+          (476,E'Tea');
+'''
+
+
+def test_scan_waits_for_files_to_settle(tmp_path):
+    (tmp_path / 'a.sql').write_text(RAW_DUMP)
+    (tmp_path / 'b.sql.part').write_text(RAW_DUMP)
+    watcher = spool.SpoolWatcher(str(tmp_path))
+    assert watcher.scan() == []
+    assert watcher.scan() == [str(tmp_path / 'a.sql')]
+    assert watcher.scan(settle=False) == [str(tmp_path / 'a.sql')]
+
+
+def test_run_once(tmp_path):
+    (tmp_path / 'a.sql').write_text(RAW_DUMP)
+    shutil.copy('lorem.txt', str(tmp_path))
+    watcher = spool.SpoolWatcher(str(tmp_path), jobs=1)
+    watcher.run(once=True)
+    assert (tmp_path / 'done' / 'a.sql').exists()
+    assert (tmp_path / 'failed' / 'lorem.txt').exists()
+    assert 'CREATE TABLE price_data (' in (tmp_path / 'out' / 'a.sql').read_text()
+    status = json.loads((tmp_path / 'status.json').read_text())
+    assert (status['processed'], status['failed'], status['in_flight']) == (1, 1, [])
+
+
+def test_process_file_removes_partial_output(tmp_path, monkeypatch):
+    def fail(self, outfile=None, **kwargs):
+        raise OSError('disk full')
+    (tmp_path / 'a.sql').write_text(RAW_DUMP)
+    monkeypatch.setattr(spool.collisions.Collisions, 'run', fail)
+    (tmp_path / 'out').mkdir()
+    path, error, seconds = spool.process_file(str(tmp_path / 'a.sql'), str(tmp_path / 'out'))
+    assert error == 'OSError: disk full'
+    assert list((tmp_path / 'out').iterdir()) == []
@@ -8,6 +8,8 @@
 # standard libs
 
 # 3rd party libs
+import io
+import os
 from unittest import TestCase
 
 import pytest
@@ -98,3 +100,304 @@ def test_split_insert_line():
         'INSERT INTO test("Name","Store #","Category","Item","Size/Quantity","Price")')
     assert 'INSERT INTO test (store_num, jan09_survey)' == sq.split_insert_line(
         'INSERT INTO test("Store #","Jan09 Survey?")')
+
+
+def test_get_table_name():
+    assert 'employees' == sq.get_table_name('DROP TABLE employees;')
+    assert 'employees' == sq.get_table_name('DROP TABLE if exists employees;')
+    assert 'all employees' == sq.get_table_name('INSERT INTO "all employees("id", "first_name")')
+    assert 'myschema.der_category_master' == sq.get_table_name('CREATE TABLE myschema.der_category_master (')
+    assert 'all employees' == sq.get_table_name('CREATE UNIQUE INDEX "idx" ON "all employees" ("id");')
+    assert 'employees' == sq.get_table_name('ALTER TABLE employees ADD FOREIGN KEY (dept) REFERENCES depts (id);')
+
+
+def test_table_selected():
+    assert sq.table_selected('R&I Trend Data', include=['r_and_i_*'])
+    assert sq.table_selected('R&I Trend Data', include=['R&I *'])
+    assert sq.table_selected('employees', include=['test001_emp*'], prefix='test001')
+    assert not sq.table_selected('employees', exclude=['emp*'])
+    assert not sq.table_selected('employees', include=['former*'])
+
+
+def test_filter_lines():
+    lines = ['DROP TABLE employees;', 'CREATE TABLE employees (', 'id INTEGER', ');',
+             'INSERT INTO employees("id")', 'VALUES(1),', '(2);',
+             'INSERT INTO former employees("id")', 'VALUES(3);']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.exclude_tables = ['former_*']
+    assert lines[:7] == list(sq.filter_lines(lines, sqrub))
+    sqrub.exclude_tables = []
+    sqrub.schema_only = True
+    assert lines[:4] == list(sq.filter_lines(lines, sqrub))
+
+
+def test_filter_lines_indexes_and_alters():
+    lines = ['CREATE INDEX emp_id ON employees (id);', 'CREATE UNIQUE INDEX fe_id ON "former employees" (id);',
+             'ALTER TABLE "former employees" ADD PRIMARY KEY (id);',
+             'ALTER TABLE employees ADD FOREIGN KEY (boss)', 'REFERENCES "former employees" (id);',
+             'ALTER TABLE employees ADD FOREIGN KEY (dept) REFERENCES depts (id);']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.exclude_tables = ['former_*']
+    assert lines[:1] + lines[5:] == list(sq.filter_lines(lines, sqrub))
+    sqrub.exclude_tables = ['depts']
+    assert lines[:5] == list(sq.filter_lines(lines, sqrub))
+    raw = [line.encode() + b'\n' for line in lines]
+    assert raw[:5] == list(sq.filter_lines(raw, sqrub, 'utf-8'))
+
+
+def test_process_raw_line():
+    sqrub = sq.Sqrubber([b'DROP TABLE employees;\n'])
+    sqrub.indent = False
+    assert b'DROP TABLE former_employees;\r\n' == sq.process_raw_line(b'DROP TABLE former employees;\r\n', sqrub)
+    assert b'    VALUES(E\'caf\xe9\'\'s\'),\r\n' == sq.process_raw_line(b'    VALUES(E\'caf\xe9\\\'s\'),\r\n', sqrub,
+                                                                    encoding='latin-1')
+    assert b'INSERT INTO test (store_num)\n' == sq.process_raw_line(b'INSERT INTO test("Store #")\n', sqrub)
+
+
+def test_check_encoding():
+    assert 'iso8859-1' == sq.check_encoding('latin-1')
+    assert 'utf-8' == sq.check_encoding('UTF8')
+    assert sq.check_encoding('utf-16') is None
+    assert sq.check_encoding('no-such-codec') is None
+
+
+def test_filter_lines_bytes():
+    lines = [b'CREATE TABLE employees (\r\n', b'"id" INTEGER\r\n', b');\r\n',
+             b'INSERT INTO employees("id")\r\n', b'    VALUES(1),\r\n', b'  (2);\r\n', b'\r\n']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.schema_only = True
+    assert lines[:3] + lines[6:] == list(sq.filter_lines(lines, sqrub, 'utf-8'))
+
+
+def test_keyword_matcher_classify():
+    assert ('keyword', 'drop table if exists', 0) == sq.MATCHER.classify('DROP TABLE if exists employees;')
+    assert ('type', 'double precision', 11) == sq.MATCHER.classify('"Returned" double precision,')
+    assert ('other', 'set names', 0) == sq.MATCHER.classify("SET NAMES 'UTF8';")
+    assert sq.MATCHER.classify('"Dud" VARCHAR') is None
+    assert sq.MATCHER.has_keyword('ALTER TABLE employees')
+
+
+def test_keyword_matcher_add_types():
+    sqrub = sq.Sqrubber(['DROP TABLE employees'])
+    sqrub.matcher = sq.MATCHER.add_types(['VARCHAR', 'numeric'])
+    assert 'dud VARCHAR(50),' == sq.process_line('"Dud" VARCHAR(50),', sqrub)
+    assert 'amount NUMERIC,' == sq.process_line('"Amount" numeric,', sqrub)
+    assert sq.MATCHER.classify('"Dud" VARCHAR') is None
+
+
+def test_sample_lines_first_rows():
+    lines = ['CREATE TABLE t (', '"id" INTEGER', ');', '',
+             'INSERT INTO t("id", "x")', 'VALUES(1,2),', '(3,4),', '(5,6);', '',
+             'INSERT INTO t("id", "x")', 'VALUES(7,8);', '',
+             'INSERT INTO u("id", "x")', 'VALUES(9,10);']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.sample = 2
+    assert lines[:5] + ['VALUES(1,2),', '(3,4);', '', '', 'INSERT INTO u("id", "x")', 'VALUES(9,10);'] == \
+        list(sq.sample_lines(lines, sqrub))
+
+
+def test_sample_lines_fraction():
+    lines = ['INSERT INTO t("id", "x")', 'VALUES(0,0),'] + ['({},{}),'.format(i, i) for i in range(1, 999)] + \
+            ['(999,999);']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.sample_fraction = 0.1
+    sampled = list(sq.sample_lines(lines, sqrub))
+    assert 50 < len(sampled) < 150
+    assert sampled[1].startswith('VALUES(')
+    assert sampled[-1].endswith(');')
+    assert all(line.endswith('),') for line in sampled[1:-1])
+
+
+def test_sample_lines_bytes():
+    lines = [b'INSERT INTO t("id", "x")\r\n', b'    VALUES(1,2),\r\n', b'  (3,4),\r\n', b'  (5,6);\r\n']
+    sqrub = sq.Sqrubber(lines)
+    sqrub.sample = 2
+    assert lines[:2] + [b'  (3,4);\r\n'] == list(sq.sample_lines(lines, sqrub, 'utf-8'))
+    assert b'  VALUES(3,4),\r\n' == sq.start_row(b'  (3,4),\r\n', 'utf-8')
+
+
+def test_process_line_constraints():
+    sqrub = sq.Sqrubber(['DROP TABLE employees'])
+    sqrub.indent = True
+    assert '     cust_id INTEGER REFERENCES s.customers(id),' == sq.process_line(
+        '"Cust ID" INTEGER REFERENCES "Customers"("ID"),', sqrub, schema='s')
+    assert '     PRIMARY KEY (store_num, item)' == sq.process_line('PRIMARY KEY ("Store #", "Item")', sqrub)
+    sqrub.indent = False
+    assert 'CREATE INDEX t_item_idx ON t_price_data (item);' == sq.process_line(
+        'CREATE INDEX "Item Idx" ON "Price Data" ("Item");', sqrub, prefix='t')
+
+
+def test_reorder_for_load():
+    lines = ['DROP TABLE IF EXISTS orders;', '', 'CREATE TABLE orders (',
+             '     id INTEGER PRIMARY KEY,', '     cust_id INTEGER REFERENCES customers(id),',
+             '     UNIQUE (cust_id)', ');', '',
+             'INSERT INTO orders (id, cust_id)', '    VALUES(1,2);', '',
+             'CREATE INDEX cust_idx ON orders (cust_id);']
+    out = [line for line in sq.reorder_for_load(lines) if line and not line.startswith('--')]
+    assert out == ['DROP TABLE IF EXISTS orders;', 'CREATE TABLE orders (', '     id INTEGER,',
+                   '     cust_id INTEGER', ');',
+                   'INSERT INTO orders (id, cust_id)', '    VALUES(1,2);',
+                   'ALTER TABLE orders ADD PRIMARY KEY (id);',
+                   'ALTER TABLE orders ADD UNIQUE (cust_id);',
+                   'ALTER TABLE orders ADD FOREIGN KEY (cust_id) REFERENCES customers(id);',
+                   'CREATE INDEX cust_idx ON orders (cust_id);']
+
+
+def test_reorder_processed_alter_table():
+    sqrub = sq.Sqrubber(['DROP TABLE employees'])
+    raw = ['CREATE TABLE "Orders" (', '"Order ID" INTEGER', ');',
+           'ALTER TABLE "Orders" ADD PRIMARY KEY ("Order ID");',
+           'INSERT INTO "Orders"("Order ID")', 'VALUES(1);']
+    lines = [sq.process_line(line, sqrub, 'p', 's') for line in raw]
+    assert 'ALTER TABLE s.p_orders ADD PRIMARY KEY (order_id);' == lines[3]
+    out = [line for line in sq.reorder_for_load(lines) if line and not line.startswith('--')]
+    assert out[-1] == lines[3] and out.index(lines[4]) < out.index(lines[3])
+
+
+def test_batch_transactions():
+    lines = ['-- comment', 'DROP TABLE a;', '', 'INSERT INTO a (id)', '    VALUES(1,2);', 'DROP TABLE b;']
+    assert ['-- comment', 'BEGIN;', 'DROP TABLE a;', '', 'INSERT INTO a (id)', '    VALUES(1,2);', 'COMMIT;',
+            'BEGIN;', 'DROP TABLE b;', 'COMMIT;'] == list(sq.batch_transactions(lines, statements=2))
+    raw = [b'DROP TABLE a;\r\n', b'DROP TABLE b;\r\n']
+    assert [b'BEGIN;\n', raw[0], b'COMMIT;\n', b'BEGIN;\n', raw[1], b'COMMIT;\n'] == \
+        list(sq.batch_transactions(raw, size=10, encoding='utf-8'))
+    # str lines are measured in encoded bytes, not characters
+    lines = ["INSERT INTO a (name) VALUES(E'ééé');", 'DROP TABLE a;']
+    assert ['BEGIN;', lines[0], 'COMMIT;', 'BEGIN;', lines[1], 'COMMIT;'] == \
+        list(sq.batch_transactions(lines, size=len(lines[0]) + 2))
+
+
+def test_unlogged_tables():
+    sqrub = sq.Sqrubber(['DROP TABLE employees'])
+    sqrub.unlogged = True
+    lines = ['CREATE TABLE orders (', '     cust_id INTEGER REFERENCES customers(id)', ');',
+             'CREATE TABLE customers (', '     id INTEGER', ');']
+    assert 'CREATE UNLOGGED TABLE orders (' == list(sqrub.prepare_output(lines))[0]
+    assert sqrub.session_postamble().endswith('ALTER TABLE customers SET LOGGED;\nALTER TABLE orders SET LOGGED;\n')
+
+
+def test_library_run_without_side_effects(capsys):
+    source = io.StringIO('DROP TABLE IF EXISTS "Price Data";\n'
+                         'CREATE TABLE "Price Data" (\n     "Store #" INTEGER\n);\n')
+    out = io.StringIO()
+    sqrub = sq.Sqrubber(source, schema='s')
+    output = sqrub.run(out)
+    sqrub.destroy()
+    assert 'CREATE TABLE s.price_data (' in output
+    assert 'CREATE TABLE s.price_data (\n' in out.getvalue()
+    # without an output the lines are only returned
+    assert ['DROP TABLE IF EXISTS price_data;'] == sq.Sqrubber(['DROP TABLE IF EXISTS "Price Data";']).run()
+    assert capsys.readouterr().out == ''
+
+
+def test_library_invalid_input():
+    with pytest.raises(sq.InvalidInputError):
+        sq.Sqrubber('no-such-dump.sql')
+    with pytest.raises(sq.InvalidInputError):
+        sq.Sqrubber(None)
+    with pytest.raises(sq.SqrubberError):
+        sq.Sqrubber(iter(['lorem ipsum'])).run(io.StringIO())
+    with pytest.raises(sq.InvalidInputError, match='already sqrubbed'):
+        sq.Sqrubber('multiple-example.sql').run()
+
+
+def test_library_byte_lines():
+    assert ['DROP TABLE a_b;', 'DROP TABLE c;'] == sq.Sqrubber([b'DROP TABLE "a b";', b'DROP TABLE c;\n']).run()
+    # stray cp1252 bytes send the lines through the bytes pipeline
+    assert [b'DROP TABLE a_b;\n', b"INSERT INTO a_b (x)\n", b"VALUES(E'caf\xe9');\n"] == \
+        sq.Sqrubber([b'DROP TABLE "a b";', b'INSERT INTO "a b"("x")', b"VALUES(E'caf\xe9');"]).run()
+
+
+def test_detect_encoding():
+    assert 'utf-8' == sq.detect_encoding('Café'.encode('utf-8'))
+    assert 'utf-8' == sq.detect_encoding('Café'.encode('utf-8')[:-1], final=False)
+    assert 'cp1252' == sq.detect_encoding('Café'.encode('cp1252'))
+    assert 'utf-8-sig' == sq.detect_encoding(b'\xef\xbb\xbf-- SQL Dump of DB_1.mdb')
+
+
+def test_sniff_input():
+    sniff, stream = sq.sniff_input('multiple-example.sql')
+    assert ('sqrubbed', 'utf-8', True, 5, True) == sniff
+    sniff, stream = sq.sniff_input('multiple-example.sql', max_bytes=400)
+    assert (sniff.sections, sniff.complete) == (1, False)
+    sniff, stream = sq.sniff_input('lorem.txt')
+    assert (sniff.format, sniff.has_ddl) == (None, False)
+
+
+def test_sniff_stops_early_on_huge_input():
+    line = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit\n'
+
+    def lorem():
+        for count in range(10 ** 6):
+            if count * len(line) > sq.SNIFF_BYTES:
+                raise AssertionError('read past the sniffed prefix')
+            yield line
+    sqrub = sq.Sqrubber(io.BytesIO())
+    sqrub.stream = lorem()
+    with pytest.raises(sq.InvalidInputError):
+        sqrub.run(io.StringIO())
+
+
+def test_late_stray_byte(tmp_path):
+    path = tmp_path / 'late.sql'
+    rows = b'    VALUES(1,2),\n' * (sq.SNIFF_BYTES // 16 + 1)
+    path.write_bytes(b'DROP TABLE IF EXISTS "A";\nINSERT INTO "A"("X","Y")\n' + rows + b"    VALUES(3,E'caf\xe9');\n")
+    out = tmp_path / 'out.sql'
+    output = sq.Sqrubber(str(path)).run(str(out))
+    assert "    VALUES(3,E'caf\udce9');" == output[-1]
+    assert out.read_bytes().endswith(b"    VALUES(3,E'caf\xe9');\n\n\n-- Sqrubber job finished")
+
+
+def test_sniffed_stream_keeps_lines():
+    lines = [b'-- generated by MDB Viewer 2.2.7\n', b'DROP TABLE IF EXISTS "A";\n', b'\xe9\n']
+    sniff, stream = sq.sniff_input(stream=iter(lines), max_bytes=40)
+    assert ('mdb', 'utf-8', True, False) == (sniff.format, sniff.encoding, sniff.has_ddl, sniff.complete)
+    assert lines == list(stream)
+
+
+def test_parse_and_render_line():
+    sqrub = sq.Sqrubber(['DROP TABLE employees'])
+    parsed = sq.parse_line('DROP TABLE if exists "Price Data";', sqrub)
+    assert 'DROP TABLE IF EXISTS price_data;' == sq.render_line(parsed)
+    assert 'DROP TABLE IF EXISTS s.p_price_data;' == sq.render_line(parsed, 'p', 's')
+    sqrub.indent = False
+    parsed = sq.parse_line('CREATE INDEX "Cust Idx" ON "Orders" ("Cust ID");', sqrub)
+    assert 'CREATE INDEX p_cust_idx ON s.p_orders (cust_id);' == sq.render_line(parsed, 'p', 's')
+
+
+def test_transform_targets():
+    lines = ['DROP TABLE IF EXISTS "Price Data";',
+             'INSERT INTO "Price Data"("Store #","Item")',
+             "    VALUES(478,E'Coffee'),",
+             "          (476,E'Tea');"]
+    sqrub = sq.Sqrubber(lines)
+    plain, staging = sqrub.transform_targets([(None, None), ('p', 'staging')])
+    assert plain == [sq.Sqrubber(lines).transform()[i] for i in range(4)]
+    assert staging[1:3] == ['DROP TABLE IF EXISTS staging.p_price_data;',
+                            'INSERT INTO staging.p_price_data (store_num, item)']
+    # rows of data are parsed once and shared between the outputs
+    assert staging[-1] is plain[-1]
+    # several targets select tables by their names without prefix and schema
+    sqrub = sq.Sqrubber(lines)
+    sqrub.exclude_tables = ['p_*']
+    assert [4, 4] == [len(output) for output in sqrub.transform_targets([('p', None), (None, None)])]
+    sqrub.exclude_tables = ['price*']
+    assert [0, 0] == [len(output) for output in sqrub.transform_targets([('p', None), (None, None)])]
+
+
+def test_main_rejects_outfile_with_target(tmp_path):
+    with pytest.raises(SystemExit) as exit_info:
+        sq.main(['-i', 'example.sql', '-o', str(tmp_path / 'out.sql'), '--target=p:s:' + str(tmp_path / 'p.sql')])
+    assert exit_info.value.code == 2
+    assert not os.path.exists(str(tmp_path / 'p.sql'))
+
+
+def test_load_selects_while_reading():
+    source = io.StringIO('DROP TABLE IF EXISTS "Price Data";\n'
+                         'INSERT INTO "Price Data"("Store #","Item")\n'
+                         "    VALUES(478,E'Coffee'),\n"
+                         "          (476,E'Tea');\n")
+    sqrub = sq.Sqrubber(source)
+    sqrub.schema_only = True
+    assert ['DROP TABLE IF EXISTS "Price Data";'] == sqrub.load()
+    assert ['DROP TABLE IF EXISTS price_data;'] == sqrub.transform()